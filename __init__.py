@@ -1,4 +1,23 @@
-import core
-import dj
-import heroku
-import responsive
+# Run through fab, only the modules of the tasks on the command line are
+# imported (`fab heroku.deploy` never loads dj or responsive). Listing the
+# tasks, or anything that names none of the modules, imports all of them.
+import importlib
+import os
+import sys
+
+MODULES = ['core', 'dj', 'heroku', 'responsive']
+
+
+def _requested_modules(argv):
+    if os.path.basename(argv[0]) != 'fab':
+        return MODULES
+    requested = set()
+    for arg in argv[1:]:
+        name = arg.split(':', 1)[0]
+        if '.' in name and name.split('.', 1)[0] in MODULES:
+            requested.add(name.split('.', 1)[0])
+    return [module for module in MODULES if module in requested] or MODULES
+
+
+for _module in _requested_modules(sys.argv):
+    importlib.import_module('.' + _module, __name__)
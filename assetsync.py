@@ -0,0 +1,79 @@
+"""
+Mirror a directory of assets into another one, touching only what changed.
+
+Files are compared by inode, then size, then content hash. Changed files are
+hardlinked to the source where the filesystem allows it (no data is copied)
+and copied otherwise, files that were deleted from the source are removed.
+"""
+import os
+import shutil
+
+from fabric.api import abort
+
+from cache import hash_file
+
+# Same thing on a remote host, rsync hardlinks from --link-dest instead of copying.
+# The source ({0}) has to be absolute, rsync resolves --link-dest from the destination.
+# The destination files are hardlinks of the source, size and mtime (rsync's quick
+# check) find the changes without reading either tree.
+REMOTE_DELTA_SYNC = (
+    "test -d {0} || {{ echo \"{0} doesn't exist\"; exit 1; }}; mkdir -p {1} && if command -v rsync >/dev/null; then "
+    "rsync -a --delete --itemize-changes --link-dest={0}/ {0}/ {1}/; "
+    "else cp -r {0}/. {1}/; fi")
+
+
+def delta_sync(source, destination):
+    """ Make destination mirror source, returns counts of what was done """
+    if not os.path.isdir(source):
+        # an empty source would delete everything in destination
+        abort("{0} doesn't exist, not syncing it into {1}".format(source, destination))
+    stats = {'unchanged': 0, 'linked': 0, 'copied': 0, 'removed': 0, 'bytes_copied': 0}
+    wanted = set()
+    for root, dirs, files in os.walk(source):
+        relative_root = os.path.relpath(root, source)
+        target_root = os.path.normpath(os.path.join(destination, relative_root))
+        if not os.path.isdir(target_root):
+            os.makedirs(target_root)
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(target_root, name)
+            wanted.add(os.path.normpath(os.path.join(relative_root, name)))
+            if _same_file(src, dst):
+                stats['unchanged'] += 1
+                continue
+            if os.path.lexists(dst):
+                os.remove(dst)
+            try:
+                os.link(src, dst)
+                stats['linked'] += 1
+            except OSError:
+                # different filesystem or no hardlink support
+                shutil.copy2(src, dst)
+                stats['copied'] += 1
+                stats['bytes_copied'] += os.path.getsize(dst)
+
+    for root, dirs, files in os.walk(destination, topdown=False):
+        relative_root = os.path.relpath(root, destination)
+        for name in files:
+            if os.path.normpath(os.path.join(relative_root, name)) not in wanted:
+                os.remove(os.path.join(root, name))
+                stats['removed'] += 1
+        for name in dirs:
+            path = os.path.join(root, name)
+            if not os.path.isdir(os.path.join(source, relative_root, name)) and not os.listdir(path):
+                os.rmdir(path)
+    return stats
+
+
+def describe(stats):
+    return "{unchanged} unchanged, {linked} linked, {copied} copied ({bytes_copied} bytes), {removed} removed".format(**stats)
+
+
+def _same_file(src, dst):
+    try:
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True
+    return src_stat.st_size == dst_stat.st_size and hash_file(src) == hash_file(dst)
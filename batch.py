@@ -0,0 +1,131 @@
+"""
+Run a group of remote steps as one script, in one round trip.
+
+The steps of a Script run in order in one remote shell (one cd, one
+virtualenv activation) and the script stops at the first step that fails.
+Every step is bracketed by marker lines, the output is streamed back with
+the step's name in front of each line and each step's exit status and
+duration are reported when it ends (and recorded in .fabcache/timings.jsonl
+like any other command).
+
+Scripts go over the system ssh with a ControlMaster socket in
+.fabcache/ssh/. ControlPersist keeps the connection open for
+env.ssh_persist seconds (default 600), so the stage processes of a deploy
+and the fab runs after it share one connection instead of each doing its
+own handshake. Steps run with sudo use `sudo -n`, the user needs
+passwordless sudo for them.
+"""
+import os
+import pipes
+import subprocess
+import time
+
+from fabric.api import abort, env
+from fabric.network import normalize
+
+from cache import cache_dir
+from timing import current_task, record
+
+MARKER = '@@fabstep'
+
+
+class Script(object):
+    """ Shell steps to run in order in `cwd`, after the `prefixes` (e.g. activating a virtualenv) """
+
+    def __init__(self, cwd=None, prefixes=()):
+        self.cwd = cwd
+        self.prefixes = list(prefixes)
+        self.steps = []
+
+    def add(self, name, command, use_sudo=False):
+        if use_sudo:
+            command = "sudo -n bash -c {0}".format(pipes.quote(command))
+        self.steps.append((name, command))
+        return self
+
+    def extend(self, steps):
+        for step in steps:
+            self.add(*step)
+        return self
+
+    def render(self):
+        lines = ["exec 2>&1"]
+        if self.cwd:
+            lines.append("cd {0} || exit 1".format(self.cwd))
+        lines.extend("{0} || exit 1".format(prefix) for prefix in self.prefixes)
+        for index, (name, command) in enumerate(self.steps):
+            # each step in a subshell, an exit inside it ends only the step. The script
+            # itself is bash's stdin, a step reading stdin (a prompt) would eat the rest
+            lines.extend([
+                "echo '{0} start {1}'".format(MARKER, index),
+                "(\n{0}\n) </dev/null".format(command),
+                "status=$?",
+                "echo \"{0} end {1} $status\"".format(MARKER, index),
+                '[ $status -eq 0 ] || exit $status',
+            ])
+        return "\n".join(lines) + "\n"
+
+
+def ssh_command(host_string=None):
+    """ ssh arguments for the host, sharing one persistent ControlMaster connection """
+    user, host, port = normalize(host_string or env.host_string)
+    command = [
+        'ssh', '-p', str(port), '-l', user,
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath={0}/%C'.format(os.path.abspath(cache_dir('ssh'))),
+        '-o', 'ControlPersist={0}'.format(int(env.get('ssh_persist', 600))),
+    ]
+    key_filenames = env.key_filename or []
+    if isinstance(key_filenames, basestring):
+        key_filenames = [key_filenames]
+    for key_filename in key_filenames:
+        command.extend(['-i', key_filename])
+    if env.disable_known_hosts:
+        command.extend(['-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null'])
+    return command + ['--', host]
+
+
+def run_script(script, warn_only=False, host_string=None):
+    """
+        Run the script on the host in one ssh session, streaming its output.
+        Returns [(step name, exit status or None when it didn't run, seconds)]
+        and aborts on a failed step unless warn_only.
+    """
+    host = host_string or env.host_string
+    process = subprocess.Popen(ssh_command(host) + ['bash -s'], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    process.stdin.write(script.render())
+    process.stdin.close()
+
+    names = [name for name, command in script.steps]
+    statuses = {}
+    started = {}
+    durations = {}
+    current = None
+    for line in iter(process.stdout.readline, ''):
+        if line.startswith(MARKER + ' '):
+            parts = line.split()
+            index = int(parts[2])
+            if parts[1] == 'start':
+                current = index
+                started[index] = time.time()
+            else:
+                statuses[index] = int(parts[3])
+                durations[index] = time.time() - started[index]
+                record('batch', current_task(), names[index], host, started[index], statuses[index])
+                print "[{0}] {1}: {2} ({3:.1f}s)".format(
+                    host, names[index], "ok" if statuses[index] == 0 else "exit {0}".format(statuses[index]),
+                    durations[index])
+                current = None
+            continue
+        print "[{0}] {1}: {2}".format(host, names[current] if current is not None else "setup", line.rstrip("\n"))
+    process.wait()
+
+    results = [(name, statuses.get(number), round(durations.get(number, 0.0), 2))
+               for number, name in enumerate(names)]
+    if process.returncode != 0 and not warn_only:
+        failed = [name for name, status, seconds in results if status not in (0, None)]
+        if failed:
+            abort("Step {0} failed on {1} (exit {2})".format(failed[0], host, process.returncode))
+        abort("Remote script failed on {0} before its steps ran (exit {1})".format(host, process.returncode))
+    return results
@@ -0,0 +1,91 @@
+"""
+Run one fabfile task inside a benchmark sandbox, see run.py.
+
+    python drive.py <sandbox> <module.task> [arg=value ...]
+
+The current directory is the sandbox project (its fabfile is this
+repository). run() and sudo() execute their commands locally with bash
+instead of over ssh, in the sandbox's fake remote host directory, so the
+responsive tasks work without a server, each call waits the "ssh" latency
+and the first one of a process "ssh connect" as well, like fabric's own
+connection. Prompts are answered from stdin.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+from fabric import api, operations
+from fabric.api import abort, env, execute
+from fabric.operations import _AttributeString, _prefix_commands, _prefix_env_vars
+
+
+_connected = set()
+
+
+def round_trip():
+    latencies = json.loads(os.environ.get('BENCH_LATENCIES') or '{}')
+    seconds = latencies.get('ssh', 0)
+    if os.getpid() not in _connected:
+        _connected.add(os.getpid())
+        seconds += latencies.get('ssh connect', 0)
+    time.sleep(seconds)
+
+
+def remote(command, shell=True, pty=True, combine_stderr=None, quiet=False, warn_only=False,
+           stdout=None, stderr=None, timeout=None, shell_escape=None, user=None, group=None):
+    """ run()/sudo() on the "remote" host, which is a directory of the sandbox """
+    wrapped = _prefix_env_vars(_prefix_commands(command, 'remote'))
+    round_trip()
+    process = subprocess.Popen(['/bin/bash', '-c', wrapped], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if not quiet:
+        print "[{0}] run: {1}".format(env.host_string, command)
+        sys.stdout.write(out)
+        sys.stdout.write(err)
+    result = _AttributeString(out.rstrip("\n"))
+    result.stderr = _AttributeString(err.rstrip("\n"))
+    result.command = command
+    result.real_command = wrapped
+    result.return_code = process.returncode
+    result.succeeded = process.returncode == 0
+    result.failed = not result.succeeded
+    if result.failed and not (warn_only or quiet or env.warn_only):
+        abort("run() received nonzero return code {0} while executing '{1}'".format(process.returncode, command))
+    return result
+
+
+def sandbox_responsive(root):
+    """ Point the responsive remote paths into the sandbox's fake host, the others derive from vhosts_dir """
+    env.vhosts_dir = os.path.join(root, 'remote', 'vhosts')
+    env.health_timeout = 10
+
+
+def parse_args(args):
+    positional, keyword = [], {}
+    for arg in args:
+        if '=' in arg:
+            key, value = arg.split('=', 1)
+            keyword[key] = value
+        else:
+            positional.append(arg)
+    return positional, keyword
+
+
+def main(root, name, args):
+    # before the fabfile imports run and sudo
+    for module in (api, operations):
+        module.run = module.sudo = remote
+    sys.path.insert(0, os.getcwd())
+    import fabfile
+
+    module_name, task_name = name.split('.')
+    sandbox_responsive(root)
+    env.hosts = os.environ.get('BENCH_HOSTS', 'bench').split(',')
+    positional, keyword = parse_args(args)
+    execute(getattr(getattr(fabfile, module_name), task_name), *positional, **keyword)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2], sys.argv[3:])
@@ -0,0 +1,58 @@
+"""
+Check routerlog.py against the recorded router log in fixtures/router.log
+(info lines, an H12 timeout and an H10 crash without a service time).
+
+    python bench/routerlog_check.py
+
+Exits 1 and prints the differences when a number is off.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from routerlog import RouterStats, parse
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'router.log')
+
+# (requests, p50, p95, errors) of each path and dyno
+EXPECTED = {
+    'paths': {
+        '/agencies/:id/edit': (3, 20, 30000, 1 / 3.0),
+        '/': (4, 50, 70, 1 / 4.0),  # the H10 line has no service time, it only counts as an error
+    },
+    'dynos': {
+        'web.1': (3, 20, 70, 0.0),
+        'web.2': (3, 50, 30000, 1 / 3.0),
+        '(none)': (1, 0.0, 0.0, 1.0),
+    },
+}
+
+
+def main():
+    with open(FIXTURE, 'r') as f:
+        stats = RouterStats().consume(parse(f))
+    problems = []
+    for group, expected in sorted(EXPECTED.items()):
+        windows = getattr(stats, group)
+        if sorted(windows) != sorted(expected):
+            problems.append("{0}: {1}, expected {2}".format(group, sorted(windows), sorted(expected)))
+            continue
+        for key, numbers in sorted(expected.items()):
+            summary = windows[key].summary()
+            actual = (summary['requests'], summary['p50'], summary['p95'], summary['errors'])
+            if any(abs(a - b) > 1e-9 for a, b in zip(actual, numbers)):
+                problems.append("{0} {1}: {2}, expected {3}".format(group, key, actual, numbers))
+    if dict(stats.codes) != {'H12': 1, 'H10': 1}:
+        problems.append("codes: {0}".format(dict(stats.codes)))
+    overall = stats.overall.summary()
+    if (overall['requests'], round(overall['rps'], 6)) != (7, 1.2):  # 7 requests from 12:00:00 to 12:00:05
+        problems.append("overall: {0} requests, {1} req/s, expected 7, 1.2".format(overall['requests'], overall['rps']))
+    for problem in problems:
+        print problem
+    print "routerlog: {0}".format("FAILED" if problems else "ok")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""
+Benchmark of the fabfile tasks against fake heroku, git, hg, pip,
+supervisorctl, curl, ssh, sudo and manage.py executables (see stub.py).
+
+    python bench/run.py [--repeat N] [--scale X] [--latency "heroku run=3"]
+                        [--only deploy] [--output results.json] [--compare old.json]
+
+Every scenario runs in a fresh sandbox (a project using this fabfile, a
+fake remote host directory and the stubs first on PATH), once cold and once
+warm, as its own fab process. Reported per run: wall time (median of the
+repeats), the number of local/run/sudo commands from .fabcache/timings.jsonl
+and the calls per stubbed program. --output saves the results with the
+commit and latencies they were measured with, --compare prints the
+difference against an earlier --output.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUB = os.path.join(BENCH_DIR, 'stub.py')
+DRIVE = os.path.join(BENCH_DIR, 'drive.py')
+
+PROGRAMS = ['heroku', 'git', 'hg', 'pip', 'supervisorctl', 'curl', 'ssh', 'sudo']
+
+# Seconds per call, "<program> <first argument>" overrides "<program>"
+LATENCIES = {
+    'heroku': 0.5,
+    'heroku run': 2.0,
+    'git': 0.01,
+    'git push': 1.0,
+    'hg': 0.05,
+    'hg pull': 0.5,
+    'pip': 0.2,
+    'pip wheel': 1.0,
+    'pip install': 0.5,
+    'manage.py': 0.3,
+    'manage.py migrate': 0.5,
+    'manage.py collectstatic': 0.5,
+    'supervisorctl': 0.05,
+    'curl': 0.01,
+    # a round trip over an open connection, and opening one (run()/sudo() too, see drive.py)
+    'ssh': 0.1,
+    'ssh connect': 0.5,
+}
+
+# name, task, task arguments, stdin (prompt answers), extra environment
+SCENARIOS = [
+    ('heroku.setup_plugins', 'heroku.setup_plugins', [], "1\n", {}),
+    ('heroku.deploy', 'heroku.deploy', [], "1\n", {}),
+    ('heroku.deploy:migrate', 'heroku.deploy', [], "1\n", {'BENCH_PENDING_MIGRATIONS': '1'}),
+    ('dj.setup', 'dj.setup', [], "n\n", {}),
+    ('responsive.deploy', 'responsive.deploy', [], "", {}),
+    ('responsive.deploy:batch', 'responsive.deploy', ['batch=yes'], "", {}),
+    # the hosts share the sandbox's one remote directory
+    ('responsive.rolling_deploy', 'responsive.rolling_deploy', ['batch_size=2'], "",
+     {'BENCH_HOSTS': 'web1,web2,web3'}),
+]
+
+GIT_CONFIG = """[remote "origin"]
+\turl = git@github.com:propelmarketing/bench.git
+[remote "heroku-staging"]
+\turl = git@heroku.com:propel-bench-staging.git
+[remote "heroku-production"]
+\turl = git@heroku.com:propel-bench-production.git
+"""
+
+MANAGE_PY = """#!{python}
+import runpy
+import sys
+sys.argv[1:1] = ['manage.py']
+runpy.run_path({stub!r}, run_name='__main__')
+"""
+
+TEMPLATES_YAML = """- model: responsive.template
+  pk: 1
+  fields: {name: bench, created: 2014-01-01}
+"""
+
+
+def build_sandbox(root):
+    """ Stubs in root/bin, the project in root/project, the remote host in root/remote """
+    python = sys.executable
+    bin_dir = os.path.join(root, 'bin')
+    os.makedirs(bin_dir)
+    for program in PROGRAMS:
+        _write(os.path.join(bin_dir, program), '#!/bin/sh\nexec {0} {1} {2} "$@"\n'.format(python, STUB, program),
+               executable=True)
+
+    project = os.path.join(root, 'project')
+    _write(os.path.join(project, '.git', 'config'), GIT_CONFIG)
+    os.symlink(REPO_DIR, os.path.join(project, 'fabfile'))
+    _write(os.path.join(project, 'projectconf.py'),
+           "DJANGO_PROJECT = 'bench'\nENVIRONMENT_VARIABLES = ['DEBUG', 'PRODUCTION']\n")
+    _write(os.path.join(project, 'requirements.txt'), "Django==1.6.11\nsouth==1.0\n")
+    _write(os.path.join(project, '.env'), "DEBUG=True\nPRODUCTION=\n")
+    _write(os.path.join(project, 'manage.py'), MANAGE_PY.format(python=python, stub=STUB), executable=True)
+    _write(os.path.join(project, 'local_settings.py.default'), "DEBUG = True\n")
+
+    vhosts = os.path.join(root, 'remote', 'vhosts')
+    app = os.path.join(vhosts, 'django', 'responsive')
+    _write(os.path.join(app, 'requirements.txt'), "Django==1.6.11\nsouth==1.0\n")
+    _write(os.path.join(app, 'manage.py'), MANAGE_PY.format(python=python, stub=STUB), executable=True)
+    templates = os.path.join(vhosts, 'django', 'responsive_templates')
+    _write(os.path.join(templates, 'templates.yaml'), TEMPLATES_YAML)
+    for index in range(20):
+        _write(os.path.join(templates, 'template_assets', "asset{0}.css".format(index)), "body {}\n" * index)
+    _write(os.path.join(vhosts, 'virtualenv', 'bin', 'activate'), "")
+    return project
+
+
+def run_scenario(root, scenario, latencies, log_dir):
+    """ Cold then warm run of a scenario in a fresh sandbox, returns {phase: measurement} """
+    name, task, args, stdin, extra = scenario
+    project = build_sandbox(root)
+    pidfile = os.path.join(root, 'gunicorn.pid')
+    gunicorn = subprocess.Popen([sys.executable, STUB, 'gunicorn'])
+    with open(pidfile, 'w') as f:
+        f.write(str(gunicorn.pid))
+
+    results = {}
+    try:
+        for phase in ('cold', 'warm'):
+            calls_log = os.path.join(root, "{0}.calls".format(phase))
+            environment = dict(os.environ, PATH=os.path.join(root, 'bin') + os.pathsep + os.environ['PATH'],
+                               BENCH_LOG=calls_log, BENCH_LATENCIES=json.dumps(latencies),
+                               BENCH_GUNICORN_PIDFILE=pidfile, **extra)
+            open(calls_log, 'w').close()
+            commands_before = len(_timings(project))
+            output_path = os.path.join(log_dir, "{0}-{1}.log".format(name.replace(':', '-'), phase))
+            started = time.time()
+            with open(output_path, 'w') as output:
+                process = subprocess.Popen([sys.executable, DRIVE, root, task] + args, cwd=project,
+                                           env=environment, stdin=subprocess.PIPE,
+                                           stdout=output, stderr=subprocess.STDOUT)
+                process.communicate(stdin)
+            wall = time.time() - started
+
+            calls = {}
+            with open(calls_log, 'r') as f:
+                for line in f:
+                    program = json.loads(line)['program']
+                    calls[program] = calls.get(program, 0) + 1
+            commands = [e for e in _timings(project)[commands_before:] if e['kind'] != 'task']
+            results[phase] = {'wall': round(wall, 3), 'commands': len(commands), 'calls': calls,
+                              'ok': process.returncode == 0, 'log': output_path}
+    finally:
+        gunicorn.terminate()
+        gunicorn.wait()
+    return results
+
+
+def benchmark(scenarios, latencies, repeat, log_dir):
+    results = {}
+    for scenario in scenarios:
+        runs = []
+        for _ in range(repeat):
+            root = tempfile.mkdtemp(prefix='fabbench-')
+            try:
+                runs.append(run_scenario(root, scenario, latencies, log_dir))
+            finally:
+                shutil.rmtree(root, ignore_errors=True)
+        for phase in ('cold', 'warm'):
+            measured = [run[phase] for run in runs]
+            walls = sorted(m['wall'] for m in measured)
+            results["{0} ({1})".format(scenario[0], phase)] = dict(
+                measured[-1], wall=walls[len(walls) // 2], ok=all(m['ok'] for m in measured))
+    return results
+
+
+def report(results, previous=None):
+    print "\n{0:36} {1:>9} {2:>9} {3:>9}  {4}".format("scenario", "wall", "change", "commands", "calls")
+    for name in sorted(results):
+        result = results[name]
+        change = ""
+        if previous and name in previous:
+            old = previous[name]['wall']
+            change = "{0:+.0%}".format((result['wall'] - old) / old) if old else ""
+        calls = " ".join("{0}={1}".format(p, n) for p, n in sorted(result['calls'].items()))
+        print "{0:36} {1:8.2f}s {2:>9} {3:9d}  {4}{5}".format(
+            name, result['wall'], change, result['commands'], calls, "" if result['ok'] else "  FAILED, see " + result['log'])
+
+
+def _timings(project):
+    path = os.path.join(project, '.fabcache', 'timings.jsonl')
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _write(path, content, executable=False):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+    if executable:
+        os.chmod(path, 0755)
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fabfile tasks against stubbed executables")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per scenario, the median wall time is kept")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiply every latency")
+    parser.add_argument('--latency', action='append', default=[], metavar="'PROGRAM [ARG]=SECONDS'")
+    parser.add_argument('--only', action='append', default=[], help="scenarios whose name contains this")
+    parser.add_argument('--output', help="save the results as json")
+    parser.add_argument('--compare', help="json saved by an earlier --output")
+    parser.add_argument('--logs', default=os.path.join(tempfile.gettempdir(), 'fabbench-logs'),
+                        help="directory for the task outputs")
+    options = parser.parse_args()
+
+    latencies = dict(LATENCIES)
+    for override in options.latency:
+        key, seconds = override.rsplit('=', 1)
+        latencies[key.strip()] = float(seconds)
+    latencies = dict((key, seconds * options.scale) for key, seconds in latencies.items())
+    scenarios = [s for s in SCENARIOS if not options.only or any(o in s[0] for o in options.only)]
+    if not os.path.isdir(options.logs):
+        os.makedirs(options.logs)
+
+    results = benchmark(scenarios, latencies, options.repeat, options.logs)
+    previous = None
+    if options.compare:
+        with open(options.compare, 'r') as f:
+            saved = json.load(f)
+        print "Compared with {0}".format(saved.get('commit') or options.compare)
+        if saved.get('latencies') != latencies:
+            print "Warning: {0} was measured with other latencies".format(options.compare)
+        previous = saved['results']
+    report(results, previous)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'commit': _commit(), 'latencies': latencies, 'results': results}, f, indent=2, sort_keys=True)
+    if not all(result['ok'] for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+On-disk caches shared by the fabfile modules.
+
+Everything is kept under .fabcache/ in the project root, it is always safe
+to delete that directory to start from scratch. It holds secrets (the
+cached heroku config has DATABASE_URL and API keys), so it is created
+readable only by its owner and with a .gitignore that ignores everything
+in it.
+"""
+import hashlib
+import json
+import os
+import time
+
+CACHE_DIR = '.fabcache'
+
+
+def cache_path(*parts):
+    """ Path inside the cache directory, creating parent directories as needed """
+    _create_cache_dir()
+    path = os.path.join(CACHE_DIR, *parts)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return path
+
+
+def cache_dir(*parts):
+    """ A directory inside the cache directory, created if needed """
+    _create_cache_dir()
+    path = os.path.join(CACHE_DIR, *parts)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def load_json(path, default=None):
+    """ Read a json file, returning default if it is missing or unreadable """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    """ Write a json file atomically so an interrupted task never leaves half a file """
+    tmp = "{0}.tmp".format(path)
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def hash_file(path, algorithm='sha1'):
+    """ Hex digest of a file's contents, read in chunks """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_files(paths):
+    """ One digest over the names and contents of several files, missing files count as empty """
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        digest.update(path + '\0')
+        if os.path.isfile(path):
+            digest.update(hash_file(path))
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+def _create_cache_dir():
+    """ Make sure the cache directory is private and ignored by git, also when an older version created it """
+    if os.path.isfile(os.path.join(CACHE_DIR, '.gitignore')):
+        return
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    os.chmod(CACHE_DIR, 0700)
+    with open(os.path.join(CACHE_DIR, '.gitignore'), 'w') as f:
+        f.write("*\n")
+
+
+class TTLCache(object):
+    """ A json file of key -> value where every entry expires after `ttl` seconds """
+
+    def __init__(self, name, ttl):
+        self.path = cache_path("{0}.json".format(name))
+        self.ttl = ttl
+
+    def _load(self):
+        return load_json(self.path, default={})
+
+    def get(self, key):
+        entry = self._load().get(key)
+        if entry is None or time.time() - entry['fetched'] > self.ttl:
+            return None
+        return entry['value']
+
+    def set(self, key, value):
+        self.update({key: value})
+
+    def update(self, values):
+        data = self._load()
+        now = time.time()
+        for key, value in values.items():
+            data[key] = {'fetched': now, 'value': value}
+        save_json(self.path, data)
+
+    def invalidate(self, *keys):
+        """ Drop the given keys, or every key when called without arguments """
+        data = self._load()
+        for key in keys or data.keys():
+            data.pop(key, None)
+        save_json(self.path, data)
@@ -0,0 +1,53 @@
+"""
+Skip collectstatic when no static source file changed since the last
+successful collection.
+
+The manifest is the version control's own content hash of every tracked
+file under a static/ directory, plus the requirement files (apps installed
+from packages ship static files too), so building it hashes nothing. When
+something did change collectstatic runs as usual, and without --clear it
+only copies the files that are newer than their collected copy.
+"""
+from cache import cache_path, hash_files, load_json, save_json
+from timing import local
+from wheelhouse import requirement_files
+
+# one "<hash> <mode> <path>" line per tracked static file, then the requirements
+REMOTE_STATIC_MANIFEST = "{ hg manifest --debug | grep -E '[ /]static/'; cat requirements.txt; }"
+
+
+def local_static_manifest(ref='HEAD'):
+    """ {path: content hash} of the static files committed at ref """
+    manifest = {}
+    for line in local('git ls-tree -r {0}'.format(ref), capture=True).splitlines():
+        info, path = line.split("\t", 1)
+        if path.startswith('static/') or '/static/' in path:
+            manifest[path] = info.split()[2]
+    manifest['requirements'] = hash_files(requirement_files(['requirements.txt']))
+    return manifest
+
+
+def static_changes(name, manifest):
+    """ Paths whose hash differs from the manifest recorded for `name` """
+    previous = load_json(cache_path('static', "{0}.json".format(name)), default={})
+    paths = set(previous) | set(manifest)
+    return sorted(path for path in paths if previous.get(path) != manifest.get(path))
+
+
+def record_static(name, manifest):
+    save_json(cache_path('static', "{0}.json".format(name)), manifest)
+
+
+def remote_collectstatic_command(manifest_path, collect, force=False):
+    """
+        The `collect` command unless the remote manifest matches the one
+        recorded in manifest_path (or force), then recording it, as one shell
+        command to run in the app directory
+    """
+    record = "{0} && {1} > {2}".format(collect, REMOTE_STATIC_MANIFEST, manifest_path)
+    if force:
+        return record
+    return (
+        'if test -f {path} && test "$({manifest} | diff {path} - | grep -c \'^[<>]\')" = 0; then '
+        'echo "No static files changed since the last collectstatic, skipping"; else {record}; fi').format(
+            path=manifest_path, manifest=REMOTE_STATIC_MANIFEST, record=record)
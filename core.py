@@ -1,7 +1,17 @@
-from fabric.api import local, task
+from timing import load_records, local, report, task
 
 
 @task
 def update():
     """Core: Update the submodules to point to newest master"""
     local('git submodule foreach git pull origin master')
+
+
+@task
+def timings(runs=10):
+    """Core: Summarize the recorded task and command timings (slowest tasks, p50/p95 per command, trends)"""
+    records = load_records()
+    if not records:
+        print "No timings recorded yet, they are written to .fabcache/timings.jsonl by every fab run"
+        return
+    report(records, runs=int(runs))
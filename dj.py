@@ -3,33 +3,55 @@ Tyrel Souza <tsouza@propelmarketing.com>
 """
 import sys
 import os
+import multiprocessing
+import time
+from distutils.spawn import find_executable
 
 from fabric.context_managers import shell_env
-from fabric.api import local, lcd, task
+from fabric.api import abort, lcd
 
-try:
-    from projectconf import DJANGO_PROJECT, ENVIRONMENT_VARIABLES
-except:
-    DJANGO_PROJECT = None
-    ENVIRONMENT_VARIABLES = []
+import envfile
+import loadtest
+import s3sync
+from shard import discover_labels, run_shards
+from stamps import Step, run_steps
+from timing import local, task
+from utils import as_bool, projectconf
+from wheelhouse import pip_environment, pip_install, requirement_files
 
 
 @task
-def copy_media():
-    """Django: Copies local media to s3"""
-    ENV = _get_env_from_file()
+def copy_media(workers=8):
+    """Django: Copies new and changed local media to s3"""
+    ENV = envfile.read()
     ENV['DEBUG'] = 'True'
     ENV['PRODUCTION'] = ''
     ENV['STAGING'] = 'True'
-    with shell_env(**ENV):
-        with lcd(_get_run_directory()):
-            local('python manage.py sync_media_s3 -p media')
+    if not s3sync.available():
+        print "boto isn't installed, falling back to sync_media_s3 (uploads everything)"
+        with shell_env(**ENV):
+            with lcd(_get_run_directory()):
+                local('python manage.py sync_media_s3 -p media')
+        return
+
+    setting = lambda name: ENV.get(name) or os.environ.get(name)
+    missing = [name for name in ('AWS_STORAGE_BUCKET_NAME', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY')
+               if not setting(name)]
+    if missing:
+        abort("{0} not set in .env or the environment".format(", ".join(missing)))
+    sync = s3sync.MediaSync(
+        setting('AWS_STORAGE_BUCKET_NAME'), setting('AWS_ACCESS_KEY_ID'),
+        setting('AWS_SECRET_ACCESS_KEY'), prefix='media',
+        endpoint=setting('AWS_S3_ENDPOINT_URL'), workers=int(workers))
+    failed = sync.sync(os.path.join(_get_run_directory(), 'media'))
+    if failed:
+        abort("{0} file(s) failed to upload, run copy_media again to retry them".format(len(failed)))
 
 
 @task
 def development():
     """Django: Run Server in Dev Mode"""
-    ENV = _get_env_from_file()
+    ENV = envfile.read()
     ENV['DEBUG'] = 'True'
     ENV['PRODUCTION'] = ''
     ENV['STAGING'] = 'True'
@@ -39,47 +61,70 @@ def development():
 
 
 @task
-def production():
-    """Django: Run server in production mode """
-    ENV = _get_env_from_file()
+def load_test(url='http://127.0.0.1:8000/', requests=1000, concurrency=10, paths=None):
+    """Django: Load tests a running server (see production:server=gunicorn), reports req/s and latency """
+    started = time.time()
+    results = loadtest.run(url, requests=int(requests), concurrency=int(concurrency),
+                           paths=paths.split() if paths else None)
+    loadtest.report(results, time.time() - started)
+
+
+@task
+def production(server='runserver', workers=None, worker_class='sync', threads=1, keepalive=5,
+               bind='127.0.0.1:8000'):
+    """Django: Run server in production mode, production:server=gunicorn for one worker per core """
+    ENV = envfile.read()
     ENV['DEBUG'] = ''
     ENV['PRODUCTION'] = 'True'
     ENV['STAGING'] = ''
-    with shell_env(**ENV):
-        with lcd(_get_run_directory()):
-            local('python manage.py runserver')
+    _serve(ENV, server, workers, worker_class, threads, keepalive, bind)
 
 
 @task
-def setup():
-    """Django: Setup Environment Variables, then pip install, then syncdb, finally migrate """
+def setup(force=False):
+    """Django: Setup Environment Variables, then pip install, then syncdb, finally migrate, each only when its inputs changed """
     ENV = _do_env_setup()
     cwd = _get_run_directory()
     ENV['CPPFLAGS'] = '-Qunused-arguments'
     ENV['CFLAGS'] = '-Qunused-arguments'
-
-    # Run bash scripts
-    if 'scripts' in os.listdir('.') and "setup.sh" in os.listdir('scripts'):
-        local('./scripts/setup.sh')
-    if 'scripts' in os.listdir('.') and "setup_dev.sh" in os.listdir('scripts'):
-        local('./scripts/setup_dev.sh')
-
-    local('pip install -r requirements.txt')
-    if os.path.isfile("requirements/local.txt"):
-        local('pip install -r requirements/local.txt')
-
-    with shell_env(**ENV):
+    requirements = ['requirements.txt', 'requirements/local.txt']
+    project = lambda *patterns: [os.path.join(cwd, pattern) for pattern in patterns]
+    settings = ['.env'] + project('*settings*.py', '*/settings/*.py')
+
+    def manage(command):
+        def step():
+            with shell_env(**ENV):
+                with lcd(cwd):
+                    local('python manage.py {0}'.format(command))
+        return step
+
+    def local_settings():
         with lcd(cwd):
             _local_settings(cwd)
-            local('python manage.py syncdb --noinput')
-            local('python manage.py migrate')
-            if DJANGO_PROJECT == "intake_forms":
-                local('python manage.py load_fields')
+
+    # Every step only runs again when its inputs changed (or a step it requires ran), see stamps.py
+    steps = []
+    for script in ('setup.sh', 'setup_dev.sh'):
+        if os.path.isfile(os.path.join('scripts', script)):
+            steps.append(Step(script, _script_step('./scripts/{0}'.format(script)), inputs=['scripts/' + script]))
+    steps.extend([
+        Step('pip', lambda: pip_install(requirements, force=as_bool(force)),
+             inputs=requirement_files(requirements), values=[pip_environment()]),
+        Step('local_settings', local_settings, inputs=project('local_settings.py.default', 'local_settings.py')),
+        Step('syncdb', manage('syncdb --noinput'), inputs=project('*models.py', '*/models/*.py') + settings,
+             requires=['pip', 'local_settings']),
+        Step('migrate', manage('migrate'), inputs=project('*/migrations/*.py') + settings,
+             requires=['pip', 'syncdb']),
+    ])
+    if projectconf('DJANGO_PROJECT') == "intake_forms":
+        steps.append(Step('load_fields', manage('load_fields'),
+                          inputs=project('*/fixtures/*', '*/load_fields.py') + settings, requires=['migrate']))
+    run_steps(steps, force=as_bool(force))
 
 @task
 def local_agency():
     """Django: setup an agency to be used with localhost"""
-    ENV = _get_env_from_file()
+    ENV = envfile.read()
     ENV['DEBUG'] = 'True'
     ENV['PRODUCTION'] = ''
     ENV['STAGING'] = 'True'
@@ -91,7 +136,7 @@ def local_agency():
 @task
 def shell():
     """Django: Run Shell"""
-    ENV = _get_env_from_file()
+    ENV = envfile.read()
     ENV['DEBUG'] = 'True'
     ENV['PRODUCTION'] = ''
     ENV['STAGING'] = 'True'
@@ -101,21 +146,19 @@ def shell():
 
 
 @task
-def staging():
-    """Django: Run server in Staging Mode"""
-    ENV = _get_env_from_file()
+def staging(server='runserver', workers=None, worker_class='sync', threads=1, keepalive=5, bind='127.0.0.1:8000'):
+    """Django: Run server in Staging Mode, staging:server=gunicorn for one worker per core"""
+    ENV = envfile.read()
     ENV['DEBUG'] = ''
     ENV['PRODUCTION'] = ''
     ENV['STAGING'] = 'True'
-    with shell_env(**ENV):
-        with lcd(_get_run_directory()):
-            local('python manage.py runserver')
+    _serve(ENV, server, workers, worker_class, threads, keepalive, bind)
 
 
 @task
 def superuser():
     """Django: Creates Superuser"""
-    ENV = _get_env_from_file()
+    ENV = envfile.read()
     ENV['DEBUG'] = 'True'
     ENV['PRODUCTION'] = ''
     ENV['STAGING'] = 'True'
@@ -125,21 +168,27 @@ def superuser():
 
 
 @task
-def test():
-    """Django: Runs the default tests"""
-    ENV = _get_env_from_file()
+def test(workers=None, labels=None):
+    """Django: Runs the default tests, sharded over one process per core (test:workers=1 for one) """
+    ENV = envfile.read()
     ENV['DEBUG'] = 'True'
     ENV['PRODUCTION'] = ''
     ENV['STAGING'] = 'True'
-    with shell_env(**ENV):
-        with lcd(_get_run_directory()):
-            local('python manage.py test')
+    cwd = _get_run_directory()
+    labels = labels.split() if labels else discover_labels(cwd, base=cwd)
+    if len(labels) < 2 or (workers and int(workers) == 1):
+        with shell_env(**ENV):
+            with lcd(cwd):
+                local('python manage.py test {0}'.format(" ".join(labels)))
+        return
+    if not run_shards('django', labels, 'python manage.py test', cwd=cwd, environment=ENV, workers=workers):
+        abort("Tests failed")
 
 
 @task
 def update_agencies():
     """Django: Update Agencies"""
-    ENV = _get_env_from_file()
+    ENV = envfile.read()
     ENV['DEBUG'] = 'True'
     ENV['PRODUCTION'] = ''
     ENV['STAGING'] = 'True'
@@ -151,12 +200,50 @@ def update_agencies():
 # Private, not picked up by Fabric
 def _get_run_directory():
     if not 'manage.py' in os.listdir('.'):
-        cwd = DJANGO_PROJECT
+        cwd = projectconf('DJANGO_PROJECT')
     else:
         cwd = '.'
     return cwd
 
 
+def _serve(ENV, server, workers, worker_class, threads, keepalive, bind):
+    """
+        runserver, or gunicorn with the app preloaded and one worker per core
+        unless told otherwise (threads > 1 makes the sync workers threaded)
+    """
+    cwd = _get_run_directory()
+    if server == 'gunicorn' and not find_executable('gunicorn'):
+        # runserver would measure the wrong server
+        abort("gunicorn isn't installed (pip install gunicorn)")
+    with shell_env(**ENV):
+        with lcd(cwd):
+            if server != 'gunicorn':
+                local('python manage.py runserver')
+                return
+            command = 'gunicorn {0} --preload --bind {1} --workers {2} --worker-class {3} --keep-alive {4}'.format(
+                _wsgi_application(cwd), bind, workers or multiprocessing.cpu_count(), worker_class, keepalive)
+            if int(threads) > 1:
+                # --threads came with gunicorn 19
+                command += ' --threads {0}'.format(threads)
+            local(command)
+
+
+def _wsgi_application(cwd):
+    """ WSGI_APPLICATION from projectconf.py, or the application of the project's wsgi.py """
+    if projectconf('WSGI_APPLICATION'):
+        return projectconf('WSGI_APPLICATION')
+    if os.path.isfile(os.path.join(cwd, 'wsgi.py')):
+        return 'wsgi:application'
+    for name in sorted(os.listdir(cwd)):
+        if os.path.isfile(os.path.join(cwd, name, 'wsgi.py')):
+            return '{0}.wsgi:application'.format(name)
+    abort("No wsgi.py in {0}, set WSGI_APPLICATION in projectconf.py".format(cwd))
+
+
+def _script_step(path):
+    return lambda: local(path)
+
+
 def _local_settings(cwd):
     """
         Copies local_settings.py.default to local_settings.py if needed
@@ -171,41 +258,23 @@ def _do_env_setup():
     """ Prompt to see if setup environment, if yes, setup, otherwise get env """
     do_env = raw_input('Setup Environment? (Y/N) ').rstrip("\n")
     if do_env.lower() == "y":
-        if not ENVIRONMENT_VARIABLES:
+        if not projectconf('ENVIRONMENT_VARIABLES'):
             print "No list 'ENVIRONMENT_VARIABLES' in projectconf.py"
             return
         ENV = _get_env_from_input()
-        _write_env_to_file(ENV)
+        envfile.write(ENV)
     else:
-        ENV = _get_env_from_file()
+        ENV = envfile.read()
     return ENV
 
 
-def _get_env_from_file():
-    """Read KEY=VALUE in from the .env file"""
-    ENV = {}
-    if os.path.isfile(".env"):
-        with open(".env", "r") as f:
-            for line in f:
-                key, value = line.rstrip("\n").split("=")
-                ENV[key] = value
-    return ENV
-
-
-def _write_env_to_file(ENV):
-    """ Write the variables to the .env file """
-    with open(".env", "w") as f:
-        for k, v in ENV.iteritems():
-            print >>f, "{0}={1}".format(k, v)
-
-
 def _get_env_from_input():
     """ Propmt the user for new environment variables and returns a dictionary """
     ENV = {}
     ENV['DEBUG'] = 'true'  # initial in case server is run by foreman
     ENV['PRODUCTION'] = ''  # initial in case server is run by foreman
     ENV['STAGING'] = 'true'  # initial in case server is run by foreman
-    for variable in ENVIRONMENT_VARIABLES:
+    for variable in projectconf('ENVIRONMENT_VARIABLES', []):
         if variable not in ENV:
             ENV[variable] = raw_input(
                 "{0}: ".format(variable.replace("_", " ").title())).rstrip("\n")
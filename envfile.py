@@ -0,0 +1,77 @@
+"""
+The project's .env file (KEY=VALUE per line, as read by foreman), shared by
+the dj and heroku tasks.
+
+Values may contain '=' and can be quoted, 'as is' or "with \\n escapes".
+Blank lines, comments and `export ` prefixes are skipped. The file is only
+parsed again when its mtime changes, read() returns a copy the caller can
+modify.
+"""
+import os
+import re
+
+ENV_FILE = '.env'
+
+_line = re.compile(r'^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_.]*)\s*=\s*(.*?)\s*$')
+_escapes = {'n': "\n", 't': "\t", 'r': "\r", '"': '"', '\\': '\\', '$': '$'}
+_cache = {}
+
+
+def read(path=ENV_FILE):
+    """ {key: value} of an env file, {} when it doesn't exist """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+    if key not in _cache:
+        with open(path, 'r') as f:
+            _cache.clear()
+            _cache[key] = parse(f.read())
+    return dict(_cache[key])
+
+
+def parse(text):
+    values = {}
+    for line in text.splitlines():
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        match = _line.match(line)
+        if match:
+            values[match.group(1)] = _unquote(match.group(2))
+    return values
+
+
+def write(values, path=ENV_FILE):
+    """ Replace the env file with the values, sorted by key and quoted where needed """
+    tmp = "{0}.tmp".format(path)
+    with open(tmp, 'w') as f:
+        for key in sorted(values):
+            f.write("{0}={1}\n".format(key, quote(values[key])))
+    os.rename(tmp, path)
+
+
+def quote(value):
+    value = str(value)
+    if not re.search(r'[\s#"\'\\$]', value):
+        return value
+    return '"{0}"'.format(
+        value.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$').replace("\n", "\\n"))
+
+
+def diff(local, remote, removable=()):
+    """
+        What turns remote into local: ({key: value} to set, [keys] to unset).
+        Only keys in `removable` are unset, the rest of remote is left alone.
+    """
+    changed = dict((key, value) for key, value in local.items() if remote.get(key) != value)
+    removed = sorted(key for key in removable if key in remote and key not in local)
+    return changed, removed
+
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == value[-1] == "'":
+        return value[1:-1]
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return re.sub(r'\\(.)', lambda m: _escapes.get(m.group(1), '\\' + m.group(1)), value[1:-1])
+    return value
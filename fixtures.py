@@ -0,0 +1,147 @@
+"""
+Load fixtures only when they changed, and from a fast format when they do.
+
+Every loaded fixture's sha1 is stamped per database, an unchanged fixture is
+not loaded again. Django parses YAML fixtures with the pure python loader,
+so a YAML fixture that does need loading is converted to JSON with the C
+loader first (cached by hash) and loaddata reads the JSON instead.
+"""
+import datetime
+import decimal
+import json
+import os
+
+from fabric.api import abort, shell_env
+
+from cache import cache_path, hash_file, hash_files, load_json, save_json
+from timing import local
+
+STREAMDUMP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'streamdump.py')
+
+# The same conversion on a remote host, takes <in.yaml> <out.json> arguments
+REMOTE_YAML_TO_JSON = (
+    "python -c \"import sys, json, yaml; "
+    "loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader); "
+    "data = yaml.load(open(sys.argv[1]), Loader=loader); "
+    "json.dump(data, open(sys.argv[2], 'w'), "
+    "default=lambda o: o.isoformat() if hasattr(o, 'isoformat') else str(o))\"")
+
+
+def load_fixture(path, database, manage='./manage.py', force=False, models=None):
+    """
+        loaddata `path` into `database` (any string naming it) unless it is
+        already loaded there. `path` can also be a streamed dump directory,
+        `models` then limits which of its models are loaded.
+    """
+    if not os.path.exists(path):
+        abort("Fixture {0} doesn't exist".format(path))
+    files = fixture_files(path, models)
+    digest = hash_file(path) if files == [path] else hash_files(files)
+    stamps_path = cache_path('fixtures', 'loaded.json')
+    key = "{0}|{1}|{2}".format(database, os.path.abspath(path), ",".join(sorted(models or [])))
+    if not force and load_json(stamps_path, default={}).get(key) == digest:
+        print "{0} is unchanged since it was loaded, skipping".format(path)
+        return False
+    if files:
+        local('{0} loaddata {1}'.format(manage, " ".join(fast_fixture(f) for f in files)))
+    stamps = load_json(stamps_path, default={})
+    stamps[key] = digest
+    save_json(stamps_path, stamps)
+    return True
+
+
+def fixture_files(path, models=None):
+    """ What to loaddata for a fixture, the file itself or the non-empty model files of a streamed dump """
+    index = load_json(os.path.join(path, 'index.json'))
+    if index is None:
+        return [path]
+    return [os.path.join(path, entry['file']) for entry in index['models']
+            if entry['rows'] and (models is None or entry['model'] in models)]
+
+
+def latest_dump(path):
+    """ The streamed dump of a fixture file (same name, no extension) when it is newer than the file """
+    directory = os.path.splitext(path)[0]
+    index = os.path.join(directory, 'index.json')
+    if os.path.isfile(index) and (not os.path.isfile(path) or os.path.getmtime(index) > os.path.getmtime(path)):
+        return directory
+    return path
+
+
+def dump_models(labels, directory, exclude=(), natural=False, chunk=2000, manage='./manage.py'):
+    """
+        Streamed, per model, gzipped dump of the labels (see streamdump.py)
+        into directory, keeping the previous dump as directory.bak
+    """
+    if os.path.isdir(directory):
+        print "### Backing up old {0} to {0}.bak ### ".format(directory)
+        local("rm -rf {0}.bak && mv {0} {0}.bak".format(directory))
+    os.makedirs(directory)
+    print "### Dumping {0} into {1} ### ".format(" ".join(labels), directory)
+    with shell_env(FIXTURE_DUMP_MODELS=" ".join(labels), FIXTURE_DUMP_EXCLUDE=" ".join(exclude),
+                   FIXTURE_DUMP_DIR=directory, FIXTURE_DUMP_CHUNK=str(chunk),
+                   FIXTURE_DUMP_NATURAL="1" if natural else ""):
+        local('echo "exec(open(\'{0}\').read())" | {1} shell --plain'.format(STREAMDUMP, manage))
+    # the shell doesn't exit non-zero when the script fails
+    if not os.path.isfile(os.path.join(directory, 'index.json')):
+        abort("Streamed dump of {0} failed, see the traceback above".format(directory))
+
+
+def forget_fixtures(database):
+    """ Drop the stamps of a database that was recreated """
+    stamps_path = cache_path('fixtures', 'loaded.json')
+    stamps = load_json(stamps_path, default={})
+    prefix = "{0}|".format(database)
+    save_json(stamps_path, dict((k, v) for k, v in stamps.items() if not k.startswith(prefix)))
+
+
+def fast_fixture(path, digest=None):
+    """ Path of a JSON copy of a YAML fixture, the fixture itself when it can't be converted """
+    yaml = _yaml() if os.path.splitext(path)[1] in ('.yaml', '.yml') else None
+    if yaml is None:
+        return path
+    digest = digest or hash_file(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    converted = cache_path('fixtures', "{0}-{1}.json".format(name, digest[:12]))
+    if not os.path.isfile(converted):
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        with open(path, 'r') as f:
+            data = yaml.load(f, Loader=loader)
+        tmp = "{0}.tmp".format(converted)
+        with open(tmp, 'w') as f:
+            json.dump(data, f, default=_json_default)
+        os.rename(tmp, converted)
+    return converted
+
+
+def remote_load_fixture_command(path, cache_dir, manage='./manage.py'):
+    """
+        load_fixture for a fixture on the remote host as one shell command, run
+        it in the app's virtualenv. The stamp and the JSON copy are kept in
+        `cache_dir`.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    return (
+        'if test "$(sha1sum < {path})" = "$(cat {stamp} 2>/dev/null)"; then '
+        'echo "{path} is unchanged since it was loaded, skipping"; else '
+        'fixture={path}; mkdir -p {cache_dir} && {convert} {path} {converted} && fixture={converted}; '
+        '{manage} loaddata $fixture && sha1sum < {path} > {stamp}; fi').format(
+            path=path, stamp="{0}/{1}.sha1".format(cache_dir, name), cache_dir=cache_dir,
+            convert=REMOTE_YAML_TO_JSON, converted="{0}/{1}.json".format(cache_dir, name), manage=manage)
+
+
+def _yaml():
+    """ PyYAML, imported when a fixture needs converting as it is slow to import (None without it) """
+    try:
+        import yaml
+    except ImportError:
+        return None
+    return yaml
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError("{0!r} is not JSON serializable".format(value))
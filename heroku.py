@@ -1,19 +1,56 @@
+import fnmatch
+import json
+import os
+import pipes
 import re
+import subprocess
+import threading
+import time
 
-from fabric.api import local, task
-try:
-    from projectconf import DJANGO_PROJECT, ENVIRONMENT_VARIABLES
-except ImportError:
-    DJANGO_PROJECT = None
-    ENVIRONMENT_VARIABLES = []
+from fabric.api import abort, env
+
+import envfile
+import postgres
+from cache import TTLCache, cache_path, load_json, save_json
+from collect import local_static_manifest, record_static, static_changes
+from routerlog import RouterStats, parse as parse_router_log
+from timing import local, task
+from utils import as_bool, projectconf
+from workers import run_parallel
+
+BUILDPACK_URL = 'https://github.com/ddollar/heroku-buildpack-multi.git'
+
+# Heroku CLI queries cached per app, override the ttl with --set heroku_cache_ttl=SECONDS
+METADATA_TTL = 60 * 60
+METADATA_QUERIES = {
+    'addons': 'heroku addons --app {0}',
+    'config': 'heroku config --shell --app {0}',
+    'databases': 'heroku pg:info --app {0}',
+    'plugins': 'heroku plugins --app {0}',
+}
 
 
 @task
-def collect_static():
-    """Heroku: Collects Static on Heroku """
+def collect_static(force=False):
+    """Heroku: Collects Static on Heroku, skipped when no static file changed since the last time """
     app = _prompt_for("app")
-    local(
-        'heroku run "cd {0};python manage.py collectstatic --noinput" --app {1}'.format(DJANGO_PROJECT, app))
+    # what the app runs is what was last pushed to its remote, not HEAD
+    ref = "{0}/master".format(_get_heroku_remote(app))
+    manifest = None
+    if subprocess.call(['git', 'rev-parse', '--verify', '--quiet', ref], stdout=open(os.devnull, 'w')) == 0:
+        manifest = local_static_manifest(ref)
+    elif not as_bool(force):
+        abort("No {0} ref, deploy to {1} (or git fetch) first, or collect_static:force=yes".format(ref, app))
+    if not as_bool(force):
+        changed = static_changes(app, manifest)
+        if not changed:
+            print "No static files changed since the last collectstatic on {0}, skipping".format(app)
+            return
+        print "{0} static file(s) changed".format(len(changed))
+    local('heroku run "cd {0};python manage.py collectstatic --noinput" --app {1}'.format(
+        projectconf('DJANGO_PROJECT'), app))
+    if manifest is not None:
+        record_static(app, manifest)
 
 
 @task
@@ -24,10 +61,33 @@ def config():
 
 
 @task
-def config_push():
-    """Heroku: Pushes your local .env configuration to Heroku """
+def config_push(prune=False):
+    """Heroku: Pushes the .env keys that differ from the app's config in one release, prune=yes unsets removed ones """
     app = _prompt_for("app")
-    local('heroku config:push --app {0}'.format(app))
+    if not os.path.isfile(envfile.ENV_FILE):
+        abort("No {0} file to push".format(envfile.ENV_FILE))
+    values = envfile.read()
+    remote = _parse_heroku_config(_get_heroku_metadata(app, ['config'], refresh=True)['config'])
+    # only keys pushed from .env before are unset, the rest (DATABASE_URL, addons) isn't ours
+    pushed_path = cache_path('heroku', app, 'pushed.json')
+    changed, removed = envfile.diff(values, remote, load_json(pushed_path, default=[]))
+    if not changed and not removed:
+        print "Heroku config of {0} already matches .env".format(app)
+    for key in sorted(changed):
+        print "{0} {1}".format("~" if key in remote else "+", key)
+    unset = removed if as_bool(prune) else []
+    for key in removed:
+        print "- {0}{1}".format(key, "" if key in unset else " (removed from .env, prune=yes unsets it)")
+    if changed:
+        local('heroku config:set {0} --app {1}'.format(
+            " ".join(pipes.quote("{0}={1}".format(key, changed[key])) for key in sorted(changed)), app))
+    if unset:
+        # a second release
+        local('heroku config:unset {0} --app {1}'.format(" ".join(unset), app))
+    # keys that weren't unset stay ours, a later prune=yes still unsets them
+    save_json(pushed_path, sorted(set(values) | (set(removed) - set(unset))))
+    if changed or unset:
+        _heroku_metadata_cache(app).invalidate('config')
 
 
 @task
@@ -38,8 +98,13 @@ def config_pull():
 
 
 @task
-def copy_database():
+def copy_database(target=None, dump=None, jobs=None, clean=False):
     """Heroku: Takes a database.dump file accessible from the web, and restores it into your heroku database """
+    if target:
+        # a local database name or postgres:// URL, restored here with pg_restore (see postgres.py)
+        location = dump or raw_input("Where is the dump? (file, directory, URL or - for stdin): ").rstrip("\n")
+        postgres.restore(location, target, jobs=jobs, clean=as_bool(clean))
+        return
     app = _prompt_for("app")
     setup_plugins(prompt=False, app=app)
     location = raw_input("Where is the database dump file?: ").rstrip("\n")
@@ -49,20 +114,51 @@ def copy_database():
 
 
 @task
-def deploy():
-    """Heroku: Push to origin then deploy to heroku, puts in maintainence mode too """
+def deploy(migrate='auto'):
+    """Heroku: Push to origin then deploy to heroku, in maintainence mode only while migrating """
     remote = _prompt_for("remote")
-    app = _get_heroku_apps(remote)
-    # Do the pushes
-    local('heroku maintenance:on --app {0}'.format(app))
+    if not remote:
+        abort("No heroku remotes in the git config, see heroku.setup_remotes")
+    branch = local('git rev-parse --abbrev-ref HEAD', capture=True)
+    _deploy_remote(remote, branch, migrate=migrate)
+
+
+@task
+def deploy_many(remotes=None, limit=4, migrate='auto'):
+    """Heroku: Deploys to several heroku remotes (names or globs) in parallel, then prints a summary """
+    if remotes is None:
+        print "\n".join(_get_heroku_remotes())
+        remotes = raw_input("Deploy to which remotes? (names or globs, space separated): ").rstrip("\n")
+    selected = _match_heroku_remotes(remotes.split())
+    if not selected:
+        abort("No heroku remotes match '{0}'".format(remotes))
     branch = local('git rev-parse --abbrev-ref HEAD', capture=True)
-    local('git push {0} {1}:master'.format(remote, branch))
-    local('heroku maintenance:off --app {0}'.format(app))
+    print "Deploying {0} to {1} ({2} at a time)".format(branch, ", ".join(selected), limit)
+
+    results = run_parallel(
+        lambda remote: _deploy_remote(remote, branch, capture=True, migrate=migrate),
+        selected, limit=int(limit))
+
+    print "\nDeploy summary:"
+    failed = []
+    for remote, elapsed, error in results:
+        if error is None:
+            print "    {0:30} ok      {1:6.1f}s".format(remote, elapsed)
+        else:
+            failed.append(remote)
+            print "    {0:30} FAILED  {1}".format(remote, _describe_error(error))
+    if failed:
+        abort("Deploy failed for {0}".format(", ".join(failed)))
 
 
 @task
-def logs():
-    """Heroku: Run the logs command """
+def logs(analyze=False, path=None, every=10):
+    """Heroku: Run the logs command, logs:analyze=yes reports router latencies per path and dyno """
+    if path:
+        # a saved log, e.g. `fab heroku.logs:path=router.log`
+        with open(path, 'r') as f:
+            RouterStats().consume(parse_router_log(f)).report()
+        return
     app = _prompt_for("app")
     # see if the user wants to tail
     tail_prompt = raw_input("Tail? (Y/N): ").rstrip("\n")
@@ -70,7 +166,28 @@ def logs():
         tail = "--tail"
     else:
         tail = ""
-    local('heroku logs {0} --app {1}'.format(tail, app))
+    if not as_bool(analyze):
+        local('heroku logs {0} --app {1}'.format(tail, app))
+        return
+
+    command = ['heroku', 'logs', '--ps', 'router', '--app', app] + ([tail] if tail else ['--num', '1500'])
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    stats = RouterStats()
+    try:
+        stats.consume(parse_router_log(iter(process.stdout.readline, '')), every=float(every) if tail else None)
+    except KeyboardInterrupt:
+        process.terminate()
+    process.wait()
+    stats.report()
+
+
+@task
+def refresh_cache(prompt=True, app=None):
+    """Heroku: Refetches the cached plugins, addons, databases and config for an app all at once """
+    if prompt:
+        app = _prompt_for("app")
+    metadata = _get_heroku_metadata(app, sorted(METADATA_QUERIES), refresh=True)
+    print "Cached {0} for {1}".format(", ".join(sorted(metadata)), app)
 
 
 @task
@@ -78,12 +195,19 @@ def setup_plugins(prompt=True, app=None):
     """Heroku: Checks if the plugins are setup correctly, and if they aren't, installs the plugins that the fabfile requires """
     if prompt:
         app = _prompt_for("app")
-    if not "heroku-config" in local('heroku plugins --app {0}'.format(app), capture=True):
+    metadata = _get_heroku_metadata(app, ['plugins', 'addons', 'config'])
+    cache = _heroku_metadata_cache(app)
+    if not "heroku-config" in metadata['plugins']:
         local('heroku plugins:install git://github.com/ddollar/heroku-config.git --app {0}'.format(app))
+        cache.invalidate('plugins')
 
-    if not "pgbackups" in local('heroku addons --app {0}'.format(app), capture=True):
+    if not "pgbackups" in metadata['addons']:
         local('heroku addons:add pgbackups --app {0}'.format(app))
-    local('heroku config:add BUILDPACK_URL=https://github.com/ddollar/heroku-buildpack-multi.git --app {0}'.format(app))
+        cache.invalidate('addons', 'databases')
+
+    if _parse_heroku_config(metadata['config']).get('BUILDPACK_URL') != BUILDPACK_URL:
+        local('heroku config:add BUILDPACK_URL={0} --app {1}'.format(BUILDPACK_URL, app))
+        cache.invalidate('config')
 
 
 @task
@@ -112,23 +236,134 @@ def rake():
 def shell():
     """Heroku: Attaches itself to a django shell """
     app = _prompt_for("app")
-    local('heroku run "cd {0};python manage.py shell" --app {1}'.format(DJANGO_PROJECT, app))
+    local('heroku run "cd {0};python manage.py shell" --app {1}'.format(projectconf('DJANGO_PROJECT'), app))
 
 
 @task
 def validate():
     """Heroku: Validates django project on Heroku"""
     app = _prompt_for("app")
-    local('heroku run "cd {0};python manage.py validate" --app {1}'.format(DJANGO_PROJECT, app))
+    local('heroku run "cd {0};python manage.py validate" --app {1}'.format(projectconf('DJANGO_PROJECT'), app))
 
 @task
-def get_database_dump():
+def get_database_dump(source=None, jobs=None, compress=6, tables=None, exclude=None, pipe=False):
+    """Heroku: Dumps an app's database with parallel pg_dump into DATABASE.dump/ and a local database """
+    if not source:
+        app = _prompt_for("app")
+        config = _parse_heroku_config(_get_heroku_metadata(app, ['config'], refresh=True)['config'])
+        source = config.get('DATABASE_URL')
+        if not source:
+            abort("{0} has no DATABASE_URL".format(app))
+        if 'sslmode' not in source:
+            source += '&sslmode=require' if '?' in source else '?sslmode=require'
     database = raw_input("Database name: ").rstrip("\n")
-    ip = raw_input("IP of Remote: ").rstrip("\n")
+    tables = tables.split() if tables else ()
+    exclude = exclude.split() if exclude else ()
     local('createdb -Upostgres {0}'.format(database))
-    local('taps pull postgres://postgres@localhost/{0} http://user:pass@{1}:5000'.format(database, ip))
-    local('pg_dump -Fc --no-acl --no-owner -h localhost -U postgres {0} > {0}.dump'.format(database))
+    if as_bool(pipe):
+        postgres.copy(source, database, tables=tables, exclude=exclude)
+        return
+    directory = "{0}.dump".format(database)
+    postgres.dump(source, directory, jobs=jobs, compress=int(compress), tables=tables, exclude=exclude)
+    postgres.restore(directory, database, jobs=jobs)
+
+
+def _deploy_remote(remote, branch, capture=False, migrate='auto'):
+    """
+        Push the branch to one remote, then migrate in maintenance mode if there
+        are migrations to run (migrate=auto looks at the migration files, yes/no
+        forces it). Returns the seconds it took, the phases are logged to
+        .fabcache/downtime.jsonl
+    """
+    app = _get_heroku_apps(remote)
+    if migrate == 'auto':
+        pending = _pending_migrations(remote, branch)
+    else:
+        pending = as_bool(migrate)
+    project = projectconf('DJANGO_PROJECT')
+    phases = {'push': 0.0, 'migrate': 0.0, 'maintenance': 0.0}
+    started = time.time()
+
+    if not project:
+        # nothing we know how to migrate, keep the whole push in maintenance
+        _progress(app, "maintenance on")
+        local('heroku maintenance:on --app {0}'.format(app), capture=capture)
+        try:
+            _progress(app, "pushing {0}".format(branch))
+            local('git push {0} {1}:master'.format(remote, branch), capture=capture)
+        finally:
+            _progress(app, "maintenance off")
+            local('heroku maintenance:off --app {0}'.format(app), capture=capture)
+        phases['push'] = phases['maintenance'] = time.time() - started
+    else:
+        _progress(app, "pushing {0}".format(branch))
+        local('git push {0} {1}:master'.format(remote, branch), capture=capture)
+        phases['push'] = time.time() - started
+        if pending:
+            window = time.time()
+            _progress(app, "maintenance on, migrating")
+            local('heroku maintenance:on --app {0}'.format(app), capture=capture)
+            try:
+                migrating = time.time()
+                local('heroku run "cd {0};python manage.py migrate" --app {1}'.format(project, app),
+                      capture=capture)
+                phases['migrate'] = time.time() - migrating
+            finally:
+                local('heroku maintenance:off --app {0}'.format(app), capture=capture)
+                phases['maintenance'] = time.time() - window
+                _progress(app, "maintenance off")
+        else:
+            _progress(app, "no pending migrations, no maintenance needed")
 
+    elapsed = time.time() - started
+    _record_downtime(app, branch, phases)
+    _progress(app, "deployed in {0:.1f}s (push {1:.1f}s, migrate {2:.1f}s, maintenance {3:.1f}s)".format(
+        elapsed, phases['push'], phases['migrate'], phases['maintenance']))
+    return elapsed
+
+
+def _pending_migrations(remote, branch):
+    """ Whether any migration file changed since the commit the remote has, unknown counts as pending """
+    process = subprocess.Popen(
+        ['git', 'diff', '--name-only', '{0}/master'.format(remote), branch, '--'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        return True
+    return any('migrations/' in path for path in out.splitlines())
+
+
+_downtime_lock = threading.Lock()
+
+
+def _record_downtime(app, branch, phases):
+    """ Append the phases of one release, the maintenance phase is the user visible downtime """
+    record = dict(((phase, round(seconds, 2)) for phase, seconds in phases.items()),
+                  app=app, branch=branch, time=int(time.time()))
+    with _downtime_lock:
+        with open(cache_path('downtime.jsonl'), 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+_progress_lock = threading.Lock()
+
+
+def _progress(app, message):
+    """ One line of progress for an app, safe to call from worker threads """
+    with _progress_lock:
+        print "[{0}] {1}".format(app, message)
+
+
+def _describe_error(error):
+    if isinstance(error, SystemExit):
+        return "aborted, see the output above"
+    return str(error) or error.__class__.__name__
+
+
+def _match_heroku_remotes(patterns):
+    """ Heroku remotes matching any of the names or glob patterns, in remote order """
+    return [remote for remote in _get_heroku_remotes()
+            if any(fnmatch.fnmatch(remote, pattern) for pattern in patterns)]
 
 
 def _get_command(cmd):
@@ -179,11 +414,46 @@ def _databases(extra):
 def _get_heroku_databases(app=None):
     if not app:
         return "DATABASE"
-    ugly = local('heroku pg:info --app {0}'.format(app), capture=True)
+    ugly = _get_heroku_metadata(app, ['databases'])['databases']
     regex = re.compile("HEROKU_POSTGRESQL_[A-Z]+_URL")
     return regex.findall(ugly)
 
 
+def _heroku_metadata_cache(app):
+    ttl = int(env.get('heroku_cache_ttl', METADATA_TTL))
+    return TTLCache("heroku/{0}".format(app), ttl)
+
+
+def _get_heroku_metadata(app, queries, refresh=False):
+    """ Cached output of the METADATA_QUERIES for an app, misses are fetched concurrently """
+    cache = _heroku_metadata_cache(app)
+    metadata = {}
+    if not refresh:
+        for query in queries:
+            value = cache.get(query)
+            if value is not None:
+                metadata[query] = value
+    missing = [query for query in queries if query not in metadata]
+
+    def fetch(query):
+        return local(METADATA_QUERIES[query].format(app), capture=True)
+
+    fetched = {}
+    for query, output, error in run_parallel(fetch, missing):
+        if error is not None:
+            raise error
+        fetched[query] = str(output)
+    if fetched:
+        cache.update(fetched)
+    metadata.update(fetched)
+    return metadata
+
+
+def _parse_heroku_config(output):
+    """ Turn `heroku config --shell` output into a dictionary """
+    return envfile.parse(output)
+
+
 def _remotes():
     remotes = _get_heroku_remotes()
     mapping, remote_strings = _map_list_to_numbers(remotes)
@@ -191,15 +461,14 @@ def _remotes():
 
 def _get_heroku_remotes():
     """Get a list of all the heroku remotes"""
-    git_remotes = local('git remote -v', capture=True).split("\n")
-    remotes = [remote.split()
-               for remote in git_remotes if remote.split()[-1] == "(fetch)"]
-    heroku_remotes = []
-    for remote in remotes:
-        if 'heroku' in remote[0]:
-            heroku_remotes.append(remote[0])
-    return heroku_remotes
+    return [name for name, url in _get_remote_registry() if 'heroku' in name]
 
+def _get_heroku_remote(app):
+    """ The heroku remote that deploys to app """
+    for name, url in _get_remote_registry():
+        if 'heroku' in name and re.split(':|\.', url)[-2] == app:
+            return name
+    abort("No heroku remote for {0}, see heroku.setup_remotes".format(app))
 
 def _apps():
     apps = _get_heroku_apps()
@@ -208,16 +477,72 @@ def _apps():
 
 def _get_heroku_apps(get_remote=None):
     """Get a list of all the apps from the git remotes"""
-    git_remotes = local('git remote -v', capture=True).split("\n")
-    remotes = [remote.split()
-               for remote in git_remotes if remote.split()[-1] == "(fetch)"]
     apps = []
-    for remote in remotes:
-        if 'heroku' in remote[0]:
-            app = re.split(':|\.', remote[1])[-2]
-            if remote[0] == get_remote:
+    for name, url in _get_remote_registry():
+        if 'heroku' in name:
+            app = re.split(':|\.', url)[-2]
+            if name == get_remote:
                 return app
             apps.append(app)
     return apps
 
 
+# Parsed remotes, keyed on the (path, mtime) of the .git/config they came from
+_remote_registry = {'key': None, 'remotes': []}
+
+
+def _git_config_path():
+    """
+        Find the repository's config from the current directory or any parent,
+        like git does, following the gitdir pointer of submodules and worktrees
+        and a worktree's commondir to the config it shares with the main checkout
+    """
+    directory = os.getcwd()
+    while not os.path.exists(os.path.join(directory, '.git')):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+    git_dir = os.path.join(directory, '.git')
+    if os.path.isfile(git_dir):
+        with open(git_dir, 'r') as f:
+            git_dir = os.path.join(directory, f.read().split(':', 1)[1].strip())
+    commondir = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(commondir):
+        with open(commondir, 'r') as f:
+            git_dir = os.path.join(git_dir, f.read().strip())
+    return os.path.normpath(os.path.join(git_dir, 'config'))
+
+
+def _get_remote_registry():
+    """ Sorted list of (name, url) remotes, only re-read when .git/config changes """
+    path = _git_config_path()
+    try:
+        key = (path, os.path.getmtime(path))
+    except (OSError, TypeError):
+        return []
+    if _remote_registry['key'] != key:
+        _remote_registry['remotes'] = _parse_git_remotes(path)
+        _remote_registry['key'] = key
+    return _remote_registry['remotes']
+
+
+def _parse_git_remotes(path):
+    """ Read the [remote "name"] sections of a git config file, like `git remote -v` """
+    section = re.compile(r'^\s*\[\s*remote\s+"(.+)"\s*\]')
+    option = re.compile(r'^\s*url\s*=\s*(.+?)\s*$')
+    remotes = {}
+    current = None
+    with open(path, 'r') as f:
+        for line in f:
+            match = section.match(line)
+            if match:
+                current = match.group(1)
+                continue
+            if line.lstrip().startswith('['):
+                current = None
+                continue
+            match = option.match(line)
+            if current and match and current not in remotes:
+                remotes[current] = match.group(1).strip('"')
+    return sorted(remotes.items())
@@ -0,0 +1,69 @@
+"""
+A small HTTP load generator, to measure a locally served site.
+
+`concurrency` threads each keep one keep-alive connection open and send GET
+requests for the paths in turn until `requests` have been sent in total.
+The report has requests per second, p50/p95/p99/max latency and the
+status codes (connection errors count as status 0).
+"""
+import httplib
+import itertools
+import threading
+import time
+import urlparse
+
+from timing import percentile
+
+
+def run(url, requests=1000, concurrency=10, paths=None, timeout=30):
+    """ Returns [(status, seconds)] of every request, in the order they finished """
+    parsed = urlparse.urlparse(url)
+    connection_class = httplib.HTTPSConnection if parsed.scheme == 'https' else httplib.HTTPConnection
+    paths = itertools.cycle(paths or [parsed.path or '/'])
+    counter = itertools.count()
+    lock = threading.Lock()
+    results = []
+
+    def worker():
+        connection = connection_class(parsed.netloc, timeout=timeout)
+        while True:
+            with lock:
+                if next(counter) >= requests:
+                    break
+                path = next(paths)
+            started = time.time()
+            try:
+                connection.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (httplib.HTTPException, IOError):
+                connection.close()
+                connection = connection_class(parsed.netloc, timeout=timeout)
+                status = 0
+            with lock:
+                results.append((status, time.time() - started))
+        connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(concurrency, requests))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join with a timeout so Ctrl+C still reaches the main thread
+        while thread.is_alive():
+            thread.join(0.1)
+    return results
+
+
+def report(results, elapsed):
+    latencies = [seconds * 1000 for status, seconds in results]
+    statuses = {}
+    for status, seconds in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print "{0} requests in {1:.1f}s: {2:.1f} req/s".format(len(results), elapsed, len(results) / max(elapsed, 0.001))
+    print "Latency: p50 {0:.1f}ms  p95 {1:.1f}ms  p99 {2:.1f}ms  max {3:.1f}ms".format(
+        percentile(latencies, 0.5), percentile(latencies, 0.95), percentile(latencies, 0.99),
+        max(latencies) if latencies else 0.0)
+    print "Status: {0}".format(", ".join(
+        "{0} x{1}".format(status or 'error', count) for status, count in sorted(statuses.items())))
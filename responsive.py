@@ -10,29 +10,113 @@
 #       execute gunicorn.
 
 import os
+import shutil
+import time
 from fabric.api import *
 from fabric.contrib.console import confirm
 from fabric.contrib.files import exists
 from contextlib import contextmanager as _contextmanager
-from time import sleep
 
-# Globals 
-# Custom variables
-env.hosts = ['responsive.propelmarketing.com']
-env.vhosts_dir = '/var/www/vhosts/responsive.propelmarketing.com'
-env.app_name = 'responsive' # example: 'sprint'
-env.app_template_name = 'responsive_templates'
-env.remote_app_dir = "{0}/django/{1}".format(env.vhosts_dir, env.app_name)
-
-# Template Fixtures Related
-env.template_fixture_filename = 'templates.yaml'
-env.remote_templates_dir = "{0}/django/{1}".format(env.vhosts_dir, env.app_template_name)
-env.local_templates_dir = '../responsive_templates'
-env.local_template_fixture = "{0}/{1}".format(env.local_templates_dir, env.template_fixture_filename)
-env.remote_template_fixture = "{0}/{1}".format(env.remote_templates_dir, env.template_fixture_filename)
+from assetsync import REMOTE_DELTA_SYNC, delta_sync, describe
+from batch import Script, run_script
+from cache import cache_path, hash_files
+from collect import remote_collectstatic_command
+from fixtures import (dump_models, fixture_files, forget_fixtures, latest_dump, load_fixture,
+                      remote_load_fixture_command)
+from shard import discover_labels, run_shards
+from stages import Stage, run_stages
+from timing import TimedTask, local, run, sudo, task as timed_task
+from utils import as_bool
+from wheelhouse import remote_pip_install_command, requirement_files, ship_wheelhouse
 
-# Virtualenv
-env.activate = 'source ' + env.vhosts_dir + '/virtualenv/bin/activate'
+# Globals 
+# Custom variables, set on env when a responsive task runs (so importing this module
+# changes nothing). Values already in env win, e.g. fab -H or --set vhosts_dir=...,
+# strings are formatted with env so they can build on the ones before them.
+ENV_DEFAULTS = [
+    ('hosts', ['responsive.propelmarketing.com']),
+    ('vhosts_dir', '/var/www/vhosts/responsive.propelmarketing.com'),
+    ('app_name', 'responsive'),  # example: 'sprint'
+    ('app_template_name', 'responsive_templates'),
+    ('remote_app_dir', "{vhosts_dir}/django/{app_name}"),
+
+    # Template Fixtures Related
+    ('template_fixture_filename', 'templates.yaml'),
+    ('remote_templates_dir', "{vhosts_dir}/django/{app_template_name}"),
+    ('local_templates_dir', '../responsive_templates'),
+    ('local_template_fixture', "{local_templates_dir}/{template_fixture_filename}"),
+    ('remote_template_fixture', "{remote_templates_dir}/{template_fixture_filename}"),
+    # What the dumps contain, the dev fixture has everything but the templates
+    ('template_fixture_labels', ['responsive.Template', 'responsive.TemplateVersion',
+                                 'responsive.TemplateSettingsField', 'responsive.TemplateSettingsFile',
+                                 'responsive.TemplateAsset', 'responsive.FieldGroup']),
+    ('dev_fixture_labels', ['responsive', 'auth.user', 'admin', 'sites', 'agency']),
+    ('test_fixture_labels', ['responsive', 'auth.user', 'admin', 'sites', 'agency']),
+    ('remote_fixture_cache', "{vhosts_dir}/fixture_cache"),  # load stamps and JSON copies
+
+    # Virtualenv
+    ('activate', "source {vhosts_dir}/virtualenv/bin/activate"),
+    ('remote_wheelhouse', "{vhosts_dir}/wheelhouse"),
+    ('requirements_stamp', "{vhosts_dir}/virtualenv/.requirements.sha1"),
+
+    # Static files, collectstatic is skipped while this manifest matches
+    ('static_manifest', "{vhosts_dir}/static.manifest"),
+
+    # Gunicorn reloads, the new workers have to answer health_url within health_timeout seconds
+    ('gunicorn_master_pid', "supervisorctl pid {app_name}"),
+    ('health_url', 'http://127.0.0.1:8000/'),
+    ('health_timeout', 60),
+]
+
+
+def _configure():
+    for key, value in ENV_DEFAULTS:
+        if not env.get(key):
+            env[key] = value.format(**env) if isinstance(value, basestring) else value
+
+
+class _ResponsiveTask(TimedTask):
+    """ Configures env before fabric picks the task's hosts and before it runs """
+
+    def get_hosts(self, *args, **kwargs):
+        _configure()
+        return super(_ResponsiveTask, self).get_hosts(*args, **kwargs)
+
+    def run(self, *args, **kwargs):
+        _configure()
+        return super(_ResponsiveTask, self).run(*args, **kwargs)
+
+
+def task(func):
+    return timed_task(task_class=_ResponsiveTask)(func)
+
+
+# Where the local settings put the sqlite dev database, in the order _reset_dev_dbs looks
+DEV_DBS = ("../resources/dev.db", "dev.db")
+
+# HUP makes the gunicorn master start new workers and gracefully stop the old ones.
+# Succeeds once every old worker is gone and the url answers, exits 2 when there is
+# no master to signal and 1 on timeout. A master that preloads the app (--preload or
+# preload_app = True in its -c config) forks the new workers from the code it loaded
+# at start, HUP would keep serving the old release: that exits 3 without signalling,
+# and the caller stops and starts gunicorn instead.
+GRACEFUL_RELOAD = (
+    'master=$({master}) && [ "$master" -gt 0 ] 2>/dev/null || exit 2; '
+    'args=$(ps -o args= -p $master); case " $args " in *" --preload "*) exit 3;; esac; '
+    'config=$(echo "$args" | sed -n "s/.*\\(-c\\|--config\\)[ =]\\([^ ]*\\).*/\\2/p"); '
+    '[ -n "$config" ] && (cd /proc/$master/cwd && grep -qE "^ *preload_app *= *True" "$config") 2>/dev/null '
+    '&& exit 3; '
+    'old=$(pgrep -P $master); kill -HUP $master || exit 2; '
+    'deadline=$(($(date +%s) + {timeout})); '
+    'while true; do '
+    'alive=; for pid in $old; do kill -0 $pid 2>/dev/null && alive=1; done; '
+    '[ -z "$alive" ] && [ -n "$(pgrep -P $master)" ] && curl -fsS -m 2 -o /dev/null {url} && exit 0; '
+    '[ $(date +%s) -ge $deadline ] && exit 1; sleep 0.5; '
+    'done')
+PRELOADED = 3
+WAIT_HEALTHY = (
+    'deadline=$(($(date +%s) + {timeout})); '
+    'until curl -fsS -m 2 -o /dev/null {url}; do [ $(date +%s) -ge $deadline ] && exit 1; sleep 0.5; done')
 
 
 def _check_vars():
@@ -56,7 +140,7 @@ def virtualenv():
 ## Main deployment function
 ##
 @task
-def deploy():
+def deploy(parallel=True, batch=False):
     # make sure all variables are all set and make understandable aliases
     if not _check_vars():
         abort('Deploy process cannot be continued.')
@@ -65,19 +149,139 @@ def deploy():
     # test()  # removed for now
     # push()
 
-    # Remote
+    # Remote, independent stages overlap unless called with deploy:parallel=no,
+    # deploy:batch=yes sends each stage's commands as one script (see batch.py)
+    stages = _batched_stages() if as_bool(batch) else _deploy_stages()
+    run_stages(stages, parallel=as_bool(parallel))
+
+
+def _deploy_stages():
+    # Every stage starts as soon as the stages it requires are done
+    return [
+        Stage('update_code', update_code),
+        Stage('update_dependencies', update_dependencies, requires=['update_code']),
+        Stage('copy_media', _copy_media, requires=['update_code']),
+        Stage('collectstatic', collectstatic, requires=['update_dependencies']),
+        Stage('remote_migrate', remote_migrate, requires=['update_dependencies']),
+        # the fixture needs the migrated schema
+        Stage('load_template', load_template, requires=['remote_migrate']),
+        Stage('reload_gunicorn', reload_gunicorn,
+              requires=['copy_media', 'collectstatic', 'load_template']),
+    ]
+
+
+def _batched_stages():
+    # Fewer, bigger stages: one ssh round trip each over a shared connection
+    return [
+        Stage('update_code', _batch_update_code),
+        Stage('copy_media', _batch_copy_media, requires=['update_code']),
+        Stage('update_app', _batch_update_app, requires=['update_code']),
+        Stage('reload_gunicorn', _batch_reload_gunicorn, requires=['copy_media', 'update_app']),
+    ]
+
+
+def _batch_update_code():
+    run_script(Script(env.remote_app_dir).extend([('hg pull', 'hg pull'), ('hg up', 'hg up')]))
+
+
+def _batch_copy_media():
+    run_script(Script(env.remote_app_dir).add('copy_media', _copy_media_command(), use_sudo=True))
+
+
+def _batch_update_app():
+    # update_dependencies, collectstatic, remote_migrate and load_template in the virtualenv
+    ship_wheelhouse(env.remote_wheelhouse)
+    run_script(Script(env.remote_app_dir, [env.activate]).extend(_host_steps() + _shared_steps()))
+
+
+def _host_steps():
+    # what every host needs for itself
+    return [
+        ('update_dependencies', remote_pip_install_command(env.remote_wheelhouse, env.requirements_stamp)),
+        ('collectstatic', remote_collectstatic_command(env.static_manifest, './manage.py collectstatic --noinput')),
+    ]
+
+
+def _shared_steps():
+    # what changes the database all hosts share
+    return [
+        ('remote_migrate', './manage.py migrate'),
+        ('load_template', remote_load_fixture_command(env.remote_template_fixture, env.remote_fixture_cache)),
+    ]
+
+
+def _batch_reload_gunicorn():
+    print "Reloading gunicorn workers, waiting for {0} to answer".format(env.health_url)
+    run_script(Script().add('reload_gunicorn', _reload_gunicorn_command(), use_sudo=True))
+
+
+def _reload_gunicorn_command():
+    # GRACEFUL_RELOAD, falling back to stop/start, as one command to run as root
+    return (
+        '( {reload} ); status=$?; [ $status -eq 0 ] && exit 0; '
+        'if [ $status -eq {preloaded} ]; then '
+        'echo "gunicorn preloads the app, new workers would run the old code: stopping and starting instead"; '
+        'else echo "Graceful reload didn\'t work (exit $status), stopping and starting instead"; fi; '
+        'supervisorctl stop {app} && sleep 5 && supervisorctl start {app} && ( {wait} ) || '
+        '{{ echo "{url} isn\'t answering after restarting gunicorn"; exit 1; }}').format(
+            reload=GRACEFUL_RELOAD.format(
+                master=env.gunicorn_master_pid, url=env.health_url, timeout=env.health_timeout),
+            preloaded=PRELOADED, app=env.app_name, url=env.health_url,
+            wait=WAIT_HEALTHY.format(url=env.health_url, timeout=env.health_timeout))
+
+
+@task
+@runs_once
+def rolling_deploy(batch_size=1, batch=False):
+    # Deploy to env.hosts (fab -H web1,web2,web3 to override) batch_size hosts at a time,
+    # each batch in parallel. The first batch also migrates and loads the templates, once,
+    # before any host reloads (so migrations have to work with the old code too).
+    # A failed batch stops the rollout, later batches keep the old code.
+    if not _check_vars():
+        abort('Deploy process cannot be continued.')
+    hosts = list(env.hosts)
+    size = max(1, int(batch_size))
+    batches = [hosts[i:i + size] for i in range(0, len(hosts), size)]
+    scripts = as_bool(batch)
+
+    deployed = []
+    for number, hosts_batch in enumerate(batches, 1):
+        print "### Batch {0}/{1}: {2} ###".format(number, len(batches), ", ".join(hosts_batch))
+        started = time.time()
+        try:
+            with settings(parallel=True, pool_size=len(hosts_batch), linewise=True):
+                execute(_update_host, scripts, hosts=hosts_batch)
+                if number == 1:
+                    execute(_update_shared, scripts, hosts=hosts_batch[:1])
+                execute(_batch_reload_gunicorn if scripts else reload_gunicorn, hosts=hosts_batch)
+        except SystemExit:
+            untouched = [host for later in batches[number:] for host in later]
+            abort("Rollout stopped at batch {0} ({1}). Deployed: {2}. Not touched: {3}".format(
+                number, ", ".join(hosts_batch), ", ".join(deployed) or "none", ", ".join(untouched) or "none"))
+        deployed.extend(hosts_batch)
+        print "### Batch {0}/{1} deployed in {2:.1f}s ###".format(number, len(batches), time.time() - started)
+
+
+def _update_host(scripts):
+    if scripts:
+        _batch_update_code()
+        _batch_copy_media()
+        ship_wheelhouse(env.remote_wheelhouse)
+        run_script(Script(env.remote_app_dir, [env.activate]).extend(_host_steps()))
+        return
     update_code()
     update_dependencies()
     _copy_media()
     collectstatic()
-    load_template()
+
+
+def _update_shared(scripts):
+    if scripts:
+        run_script(Script(env.remote_app_dir, [env.activate]).extend(_shared_steps()))
+        return
     remote_migrate()
-    stop_gunicorn()
+    load_template()
 
-    # Sometimes gunicorn would not start if I don't give it enough time
-    print "Sleeping... Making sure the old processes are killed before starting new ones..."
-    sleep(5)
-    start_gunicorn()
 
 # Atomic Functions
 @task
@@ -85,10 +289,18 @@ def help():
     print """
         # LOCAL
         help - Prints this message
-        setup_localdev - Setup local development databases and media files
-        deploy - Deploy to remote hosts through logical steps
+        setup_localdev - Setup local development databases and media files, the database
+                         is copied from a snapshot when no migration, fixture or
+                         requirement changed (setup_localdev:force=yes to rebuild)
+        deploy - Deploy to remote hosts through logical steps, overlapping
+                 independent ones (deploy:parallel=no to run them one by one,
+                 deploy:batch=yes to send each group of steps as one script over
+                 a shared ssh connection, sudo steps then need passwordless sudo)
         dump_template - Dump only template data and create 'fixtures/templates.yaml'
-        test - Run unit and fts tests locally on specified app
+                        (dump_template:stream=yes for a gzipped dump per model, same
+                        for update_dev_template and update_test_template)
+        test - Run unit and fts tests locally on specified app, split over one process
+               per core (test:workers=1 runs test_unit then test_fts)
         test_unit - Run all unit tests
         test_fts - Run all functional tests (dependent of port 8081)
         push - Push local repository to main repository
@@ -96,23 +308,53 @@ def help():
 
 
         # REMOTE
+        rolling_deploy - Deploy to the hosts batch_size at a time (rolling_deploy:batch_size=2),
+                         migrating once with the first batch and stopping at the first
+                         failed batch. batch=yes as with deploy
         update_code - Pull and Update on remote hosts
         update_dependencies - Install any new dependencies in requirements.txt
-        collectstatic - copy static files to STATIC_ROOT directory
+        collectstatic - copy static files to STATIC_ROOT directory, skipped when
+                        no static file changed (collectstatic:force=yes to run anyway)
         start_gunicorn - start gunicorn server
         stop_gunicorn - stop gunicorn server
+        reload_gunicorn - swap in new gunicorn workers without downtime, falls back
+                          to stop/start (env.health_url has to answer afterwards).
+                          A gunicorn that preloads the app (--preload, preload_app)
+                          keeps its old code on HUP, it is always stopped and started
         remote_migrate - migrate database on remote hosts
         """
 
 @task
-def test():
+def test(workers=None):
     print "Running tests locally...."
+    if not workers or int(workers) > 1:
+        return _test_sharded(workers)
     with settings(warn_only=True):
         result1 = test_unit()
         result2 = test_fts()
     if result1.failed or result2.failed and not confirm('Test failed.  Continue anyway?'):
         abort('Aborting at user request.')
 
+def _test_sharded(workers):
+    # test modules spread over the workers, each fts worker on its own liveserver port
+    unit_labels = discover_labels("{0}/tests/unit".format(env.app_name))
+    fts_labels = discover_labels("{0}/tests/fts".format(env.app_name))
+    local('sudo -v')
+    # like dj.test, a single process when there is nothing to split (test_unit/test_fts run the package)
+    with settings(warn_only=True):
+        if len(unit_labels) < 2:
+            passed = test_unit().succeeded
+        else:
+            passed = run_shards('unit', unit_labels, './manage.py test', workers=workers, sudo=True)
+        if len(fts_labels) < 2:
+            passed = test_fts().succeeded and passed
+        else:
+            local('cp -r ./fixtures/media ./')  # old assets need for test template
+            passed = run_shards('fts', fts_labels, './manage.py test', workers=workers,
+                                liveserver_port=8081, sudo=True) and passed
+    if not passed and not confirm('Test failed.  Continue anyway?'):
+        abort('Aborting at user request.')
+
 @task
 def test_unit():
     print "Running Unit Tests"
@@ -140,12 +382,12 @@ def update_code():
         run('hg pull')  # pull remotely
         run('hg up')
 
-# Update any new dependencies
+# Update any new dependencies, skipped when requirements.txt hasn't changed
 @task
 def update_dependencies():
-    if run("test -f %s/requirements.txt" % env.remote_app_dir).succeeded:
-        with virtualenv():
-            run("pip install -r requirements.txt")
+    ship_wheelhouse(env.remote_wheelhouse)
+    with virtualenv():
+        run(remote_pip_install_command(env.remote_wheelhouse, env.requirements_stamp))
 
 @task
 def remote_migrate():
@@ -154,20 +396,23 @@ def remote_migrate():
             run('./manage.py migrate')
 
 def _copy_media():
+    # only changed assets are linked or copied, deleted ones are removed
     with cd(env.remote_app_dir):
-        sudo("cp -r {0}/template_assets ./media".format(env.remote_templates_dir))
+        sudo(_copy_media_command())
+
+def _copy_media_command():
+    return REMOTE_DELTA_SYNC.format("{0}/template_assets".format(env.remote_templates_dir), "./media/template_assets")
 
 @task
-def collectstatic():
-    with cd(env.remote_app_dir):
-        with virtualenv():
-            run('./manage.py collectstatic --noinput')
+def collectstatic(force=False):
+    with virtualenv():
+        run(remote_collectstatic_command(env.static_manifest, './manage.py collectstatic --noinput', as_bool(force)))
 
 @task
 def load_template():
-    with cd(env.remote_app_dir):
-        with virtualenv():
-            run('./manage.py loaddata {0}'.format(env.remote_template_fixture))
+    # skipped when templates.yaml hasn't changed since it was last loaded
+    with virtualenv():
+        run(remote_load_fixture_command(env.remote_template_fixture, env.remote_fixture_cache))
 
 @task
 def stop_gunicorn():
@@ -179,6 +424,14 @@ def start_gunicorn():
     print "Starting gunicorn servers using Supervisor"
     sudo('supervisorctl start {0}'.format(env.app_name))
 
+@task
+def reload_gunicorn():
+    # Zero downtime: new workers take over before the old ones go away
+    print "Reloading gunicorn workers, waiting for {0} to answer".format(env.health_url)
+    with settings(warn_only=True):
+        if sudo(_reload_gunicorn_command()).failed:
+            abort("Reloading gunicorn failed on {0}, see the output above".format(env.host_string))
+
 ## Copied from the original development fabfile
 @task
 def deploy_localdev():
@@ -211,6 +464,8 @@ def _reset_dev_dbs():
         local("rm ../resources/dev.db")
     elif os.path.isfile("dev.db"):
         local("rm dev.db")
+    for database in DEV_DBS:
+        forget_fixtures(os.path.abspath(database))
 
     ### Sync the DB
     local("./manage.py syncdb --noinput")
@@ -221,80 +476,123 @@ def _reset_dev_dbs():
     #    permissions data from the fixture)
     # local("./manage.py reset contenttypes --noinput") 
 
+def _dev_db():
+    ### The dev database file, where syncdb created it (None before that).
+    ### Fixtures are stamped as loaded per dev database, see fixtures.py
+    for database in DEV_DBS:
+        if os.path.isfile(database):
+            return os.path.abspath(database)
+    return None
+
+def _fixture_db():
+    ### What loaded fixtures are stamped against, also before the database file exists
+    return _dev_db() or os.path.abspath(DEV_DBS[-1])
+
 def _load_dev_fixtures():
     ### Load the Dev fixtures
-    local("./manage.py loaddata fixtures/dev.yaml")
+    load_fixture(latest_dump("fixtures/dev.yaml"), _fixture_db())
     _load_local_templates_fixtures()
 
 def _load_test_fixtures():
     ### Load the Test fixtures
-    local("./manage.py loaddata fixtures/test.yaml")
+    load_fixture(latest_dump("fixtures/test.yaml"), _fixture_db())
     _load_local_templates_fixtures()
 
 def _load_local_templates_fixtures():
-    local("./manage.py loaddata {0}".format(env.local_template_fixture))  # has all available templates of repository
+    load_fixture(latest_dump(env.local_template_fixture), _fixture_db())  # has all available templates of repository
 
 
 @task
-def setup_localdev():
-    _reset_dev_dbs()
-    _load_dev_fixtures()
+def setup_localdev(force=False):
+    _setup_dev_db('dev', _load_dev_fixtures, "fixtures/dev.yaml", as_bool(force))
     copy_media_files()
 
 @task
-def setup_localtestdev():
-    _reset_dev_dbs()
-    _load_test_fixtures()
+def setup_localtestdev(force=False):
+    _setup_dev_db('test', _load_test_fixtures, "fixtures/test.yaml", as_bool(force))
     copy_media_files()
 
+def _setup_dev_db(name, load_fixtures, fixture, force=False):
+    ### Copy a snapshot of the built dev database into place when one matches the
+    ### migrations, fixtures and requirements, otherwise build it and snapshot it
+    inputs = _migration_files() + fixture_files(latest_dump(fixture)) + \
+        fixture_files(latest_dump(env.local_template_fixture)) + requirement_files(['requirements.txt'])
+    snapshot = cache_path('dbsnapshots', "{0}-{1}.db".format(name, hash_files(inputs)))
+    # restored over the existing database only, its location is where the settings put it
+    if os.path.isfile(snapshot) and _dev_db() and not force:
+        print "### Nothing changed since the last {0} database was built, restoring the snapshot ###".format(name)
+        forget_fixtures(_dev_db())
+        shutil.copyfile(snapshot, _dev_db())
+        return
+
+    _reset_dev_dbs()
+    load_fixtures()
+    for old_snapshot in os.listdir(os.path.dirname(snapshot)):
+        if old_snapshot.startswith("{0}-".format(name)):
+            os.remove(os.path.join(os.path.dirname(snapshot), old_snapshot))
+    if not _dev_db():
+        print "### No {0} found after syncdb, not snapshotting the {1} database ###".format(" or ".join(DEV_DBS), name)
+        return
+    shutil.copyfile(_dev_db(), snapshot)
+
+def _migration_files():
+    migrations = []
+    for root, dirs, files in os.walk('.'):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d not in ('media', 'node_modules')]
+        if os.path.basename(root) == 'migrations':
+            migrations.extend(os.path.join(root, f) for f in files if f.endswith('.py'))
+    return migrations
+
 @task
 def copy_media_files():
-    # Load media files
-    local("cp -r {0}/template_assets ./media".format(env.local_templates_dir))
+    # Load media files, only the ones that changed since the last copy
+    stats = delta_sync("{0}/template_assets".format(env.local_templates_dir), "./media/template_assets")
+    print "Template assets: {0}".format(describe(stats))
+
+# dumps with stream=yes go to a directory named after the fixture (fixtures/dev/ for
+# fixtures/dev.yaml), one gzipped json file per model plus an index.json of row counts
 
 @task
-def update_test_template():
+def update_test_template(stream=False):
     test_fixture = 'fixtures/test.yaml'
+    if as_bool(stream):
+        dump_models(env.test_fixture_labels, os.path.splitext(test_fixture)[0], natural=True)
+        return
     with settings(warn_only=True):
         if local("test -f %s" % test_fixture).succeeded:
             print "### Backing up old {0} to {0}.bak ### ".format(test_fixture)
             local("mv {0} {0}.bak".format(test_fixture))
     print ("### Dumping new {0} from database ### ".format(test_fixture))
-    local("./manage.py dumpdata --format=yaml --indent=4 --natural\
-            responsive auth.user admin sites agency > {0}".format(test_fixture))
+    local("./manage.py dumpdata --format=yaml --indent=4 --natural {0} > {1}".format(
+        " ".join(env.test_fixture_labels), test_fixture))
 
 @task
-def update_dev_template():
+def update_dev_template(stream=False):
     dev_fixture = 'fixtures/dev.yaml'
+    if as_bool(stream):
+        dump_models(env.dev_fixture_labels, os.path.splitext(dev_fixture)[0],
+                    exclude=env.template_fixture_labels, natural=True)
+        return
     with settings(warn_only=True):
         if local("test -f %s" % dev_fixture).succeeded:
             print "### Backing up old {0} to {0}.bak ### ".format(dev_fixture)
             local("mv {0} {0}.bak".format(dev_fixture))
     print ("### Dumping new {0} from database ### ".format(dev_fixture))
-    local("./manage.py dumpdata --format=yaml --indent=4 --natural\
-            --exclude=responsive.Template \
-            --exclude=responsive.TemplateVersion \
-            --exclude=responsive.TemplateSettingsField \
-            --exclude=responsive.TemplateSettingsFile \
-            --exclude=responsive.TemplateAsset \
-            --exclude=responsive.FieldGroup \
-            responsive auth.user admin sites agency \
-            > {0}".format(dev_fixture))
+    local("./manage.py dumpdata --format=yaml --indent=4 --natural {0} {1} > {2}".format(
+        " ".join("--exclude={0}".format(label) for label in env.template_fixture_labels),
+        " ".join(env.dev_fixture_labels), dev_fixture))
     
 
 # This method helps designers to dump template data and update to repository
 @task
-def dump_template():
+def dump_template(stream=False):
+    if as_bool(stream):
+        dump_models(env.template_fixture_labels, os.path.splitext(env.local_template_fixture)[0])
+        return
     with settings(warn_only=True):
         if local("test -f %s" % env.local_template_fixture).succeeded:
             print "### Backing up old {0} to {0}.bak ### ".format(env.local_template_fixture)
             local("mv {0} {0}.bak".format(env.local_template_fixture))
     print ("### Dumping new template.yaml from database ### ")
-    local("./manage.py dumpdata --format=yaml --indent=4 \
-            responsive.Template \
-            responsive.TemplateVersion \
-            responsive.TemplateSettingsField \
-            responsive.TemplateSettingsFile \
-            responsive.TemplateAsset \
-            responsive.FieldGroup \
-            > {0}".format(env.local_template_fixture))
+    local("./manage.py dumpdata --format=yaml --indent=4 {0} > {1}".format(
+        " ".join(env.template_fixture_labels), env.local_template_fixture))
@@ -0,0 +1,140 @@
+"""
+Heroku router log analysis, for finding slow endpoints and dynos.
+
+`heroku logs` output (or a saved log file) goes through a pipeline of
+generators: lines -> parse() -> RouterStats.add(). Only heroku[router]
+lines are kept, each becomes a dict of its key=value fields with connect,
+service, status and bytes as numbers and the H-code of error lines.
+
+RouterStats keeps the last WINDOW requests overall, per path and per dyno,
+and reports p50/p95/p99 service times, requests per second and error rates
+over those windows. Paths are grouped by replacing ids with :id and at
+most MAX_KEYS paths are tracked, the rest count as (other), so memory stays
+bounded however long the log is tailed.
+"""
+import calendar
+import collections
+import re
+import time
+
+from timing import percentile
+
+WINDOW = 1000
+MAX_KEYS = 200
+
+_field = re.compile(r'(\w+)=("[^"]*"|\S*)')
+_timestamp = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?')
+_ids = re.compile(r'/(?:\d+|[0-9a-f]{8}-[0-9a-f-]{27,}|[0-9a-f]{24,})(?=/|$)')
+
+
+def parse(lines):
+    """ Router records of log lines, other lines are skipped """
+    for line in lines:
+        if 'heroku[router]:' not in line:
+            continue
+        record = dict((key, value.strip('"')) for key, value in _field.findall(line.split('heroku[router]:', 1)[1]))
+        if 'path' not in record:
+            continue
+        for key in ('connect', 'service', 'bytes', 'status'):
+            try:
+                record[key] = int(record.get(key, '').rstrip('ms'))
+            except ValueError:
+                record[key] = None
+        record['time'] = _parse_time(line)
+        record['error'] = record.get('at') == 'error' or (record['status'] or 0) >= 500
+        yield record
+
+
+def normalize_path(path):
+    """ /agencies/12/edit?x=1 -> /agencies/:id/edit """
+    return _ids.sub('/:id', path.split('?', 1)[0]) or '/'
+
+
+class Window(object):
+    """ The last `size` requests: service time (None when the router had none), error flag and log time """
+
+    def __init__(self, size=WINDOW):
+        self.samples = collections.deque(maxlen=size)
+        self.total = 0
+
+    def add(self, record):
+        self.samples.append((record['service'], record['error'], record['time']))
+        self.total += 1
+
+    def summary(self):
+        # errors without a service time (H10 has service=) count for the error rate only
+        services = [service for service, error, when in self.samples if service is not None]
+        times = [when for service, error, when in self.samples if when is not None]
+        span = max(times) - min(times) if len(times) > 1 else 0
+        return {
+            'requests': self.total,
+            'p50': percentile(services, 0.5),
+            'p95': percentile(services, 0.95),
+            'p99': percentile(services, 0.99),
+            'rps': (len(times) - 1) / span if span else 0.0,  # n requests span n - 1 intervals
+            'errors': float(len([1 for service, error, when in self.samples if error])) / max(1, len(self.samples)),
+        }
+
+
+class RouterStats(object):
+
+    def __init__(self, window=WINDOW, max_keys=MAX_KEYS):
+        self.window = window
+        self.max_keys = max_keys
+        self.overall = Window(window)
+        self.paths = {}
+        self.dynos = {}
+        self.codes = collections.Counter()
+
+    def add(self, record):
+        self.overall.add(record)
+        self._window(self.paths, normalize_path(record['path'])).add(record)
+        self._window(self.dynos, record.get('dyno') or '(none)').add(record)
+        if record.get('code'):
+            self.codes[record['code']] += 1
+
+    def consume(self, records, every=None):
+        """ Add all the records, reporting every `every` seconds of wall time """
+        last = time.time()
+        for record in records:
+            self.add(record)
+            if every and time.time() - last >= every:
+                self.report()
+                last = time.time()
+        return self
+
+    def report(self, top=10):
+        lines = []
+        row = "    {0:40} {1:>7} {2:>7} {3:>7} {4:>7} {5:>7.1f} {6:>6.1%}"
+        header = "    {0:40} {1:>7} {2:>7} {3:>7} {4:>7} {5:>7} {6:>6}".format(
+            '', 'reqs', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'errors')
+        overall = self.overall.summary()
+        lines.append("Router: {0} requests, last {1}: p50 {2}ms p95 {3}ms p99 {4}ms, {5:.1f} req/s, {6:.1%} errors".format(
+            overall['requests'], min(overall['requests'], self.window), overall['p50'], overall['p95'],
+            overall['p99'], overall['rps'], overall['errors']))
+        for title, windows in (("Slowest paths (by p95):", self.paths), ("Dynos:", self.dynos)):
+            lines.extend(["", title, header])
+            summaries = sorted(((key, window.summary()) for key, window in windows.items()),
+                               key=lambda item: -item[1]['p95'])
+            for key, summary in summaries[:top]:
+                lines.append(row.format(key[:40], summary['requests'], summary['p50'], summary['p95'],
+                                        summary['p99'], summary['rps'], summary['errors']))
+        if self.codes:
+            lines.extend(["", "Errors: " + ", ".join(
+                "{0} x{1}".format(code, count) for code, count in self.codes.most_common())])
+        print "\n".join(lines) + "\n"
+
+    def _window(self, windows, key):
+        if key not in windows and len(windows) >= self.max_keys:
+            key = '(other)'
+        if key not in windows:
+            windows[key] = Window(self.window)
+        return windows[key]
+
+
+def _parse_time(line):
+    match = _timestamp.match(line)
+    if not match:
+        return None
+    seconds = calendar.timegm(time.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S'))
+    return seconds + float(match.group(2) or 0)
@@ -0,0 +1,152 @@
+"""
+Incremental, parallel upload of a media directory to S3.
+
+A manifest of what was already uploaded (path -> size, mtime, md5) is kept
+per bucket and prefix in .fabcache/s3/, so only new or changed files are
+uploaded. Files are hashed only when their size or mtime changed. Uploads
+run on a thread pool (one boto connection per thread) and big files go up
+as multipart uploads.
+
+Needs boto, AWS_S3_ENDPOINT_URL points it at an S3 compatible stand-in such
+as moto_server or MinIO, e.g. http://localhost:9000
+"""
+import base64
+import binascii
+import mimetypes
+import os
+import threading
+import time
+from urlparse import urlparse
+
+from cache import cache_path, hash_file, load_json, save_json
+from workers import run_parallel
+
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024  # S3's minimum part size is 5MB
+
+
+def available():
+    return _boto() is not None
+
+
+def _boto():
+    """ boto.s3.connection, imported on first use as boto is slow to import (None without boto) """
+    try:
+        from boto.s3 import connection
+    except ImportError:
+        return None
+    return connection
+
+
+class MediaSync(object):
+    """ Upload the new and changed files of a directory to bucket/prefix """
+
+    def __init__(self, bucket, access_key, secret_key, prefix='media', endpoint=None,
+                 workers=8, policy='public-read'):
+        self.bucket_name = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.prefix = prefix.strip('/')
+        self.endpoint = endpoint
+        self.workers = workers
+        self.policy = policy
+        self.manifest_path = cache_path('s3', "{0}-{1}.json".format(bucket, self.prefix.replace('/', '_')))
+        self._local = threading.local()
+
+    def plan(self, directory):
+        """ (uploads, skipped bytes, manifest) where uploads are (path, name, size, mtime, md5) """
+        manifest = load_json(self.manifest_path, default={})
+        uploads = []
+        skipped = 0
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for filename in files:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, directory).replace(os.sep, '/')
+                stat = os.stat(path)
+                known = manifest.get(name)
+                if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+                    skipped += stat.st_size
+                    continue
+                md5 = hash_file(path, 'md5')
+                if known and known['size'] == stat.st_size and known['md5'] == md5:
+                    # touched but not changed, just remember the new mtime
+                    known['mtime'] = stat.st_mtime
+                    skipped += stat.st_size
+                    continue
+                uploads.append((path, name, stat.st_size, stat.st_mtime, md5))
+        return uploads, skipped, manifest
+
+    def sync(self, directory):
+        """ Upload what changed and print a summary, returns the names that failed """
+        started = time.time()
+        uploads, skipped, manifest = self.plan(directory)
+        print "{0} file(s) to upload to s3://{1}/{2}, {3} unchanged".format(
+            len(uploads), self.bucket_name, self.prefix, _size(skipped))
+
+        results = run_parallel(self._upload, uploads, limit=self.workers)
+        uploaded = 0
+        failed = []
+        for (path, name, size, mtime, md5), result, error in results:
+            if error is not None:
+                failed.append(name)
+                print "Failed to upload {0}: {1}".format(name, error)
+                continue
+            uploaded += size
+            manifest[name] = {'size': size, 'mtime': mtime, 'md5': md5}
+        save_json(self.manifest_path, manifest)
+
+        elapsed = time.time() - started
+        print "Uploaded {0} in {1:.1f}s ({2}/s), saved {3} by skipping unchanged files".format(
+            _size(uploaded), elapsed, _size(uploaded / elapsed if elapsed else 0), _size(skipped))
+        return failed
+
+    def _bucket(self):
+        """ boto connections aren't thread safe, every worker gets its own """
+        if not hasattr(self._local, 'bucket'):
+            boto = _boto()
+            if self.endpoint:
+                url = urlparse(self.endpoint)
+                connection = boto.S3Connection(
+                    self.access_key, self.secret_key, host=url.hostname, port=url.port,
+                    is_secure=url.scheme == 'https', calling_format=boto.OrdinaryCallingFormat())
+            else:
+                connection = boto.S3Connection(self.access_key, self.secret_key)
+            self._local.bucket = connection.get_bucket(self.bucket_name, validate=False)
+        return self._local.bucket
+
+    def _upload(self, upload):
+        path, name, size, mtime, md5 = upload
+        bucket = self._bucket()
+        key_name = "{0}/{1}".format(self.prefix, name) if self.prefix else name
+        headers = {'Content-Type': mimetypes.guess_type(name)[0] or 'application/octet-stream'}
+        if size < MULTIPART_THRESHOLD:
+            key = bucket.new_key(key_name)
+            md5_b64 = base64.b64encode(binascii.unhexlify(md5))
+            key.set_contents_from_filename(path, headers=headers, policy=self.policy, md5=(md5, md5_b64))
+            return size
+
+        multipart = bucket.initiate_multipart_upload(key_name, headers=headers, policy=self.policy)
+        try:
+            with open(path, 'rb') as f:
+                offset, part = 0, 1
+                while offset < size:
+                    length = min(PART_SIZE, size - offset)
+                    f.seek(offset)
+                    multipart.upload_part_from_file(f, part, size=length)
+                    offset, part = offset + length, part + 1
+            multipart.complete_upload()
+        except:
+            multipart.cancel_upload()
+            raise
+        return size
+
+
+def _size(num):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num < 1024:
+            return "{0:.1f}{1}".format(num, unit)
+        num /= 1024.0
+    return "{0:.1f}TB".format(num)
@@ -0,0 +1,165 @@
+"""
+Run a Django test suite as several `manage.py test` processes at once.
+
+Test labels (dotted test modules, as found by Django 1.6+ test discovery)
+are spread over the workers longest first onto the least loaded worker,
+using durations recorded by earlier runs in .fabcache/test_durations.json.
+Only a shard's total time can be measured, it is split over its labels in
+proportion to their previous estimates so the estimates settle over runs.
+
+Every worker gets its own test database (a generated settings module that
+renames the test databases, sqlite stays in memory) and, when asked for,
+its own live server port. The outputs go to .fabcache/shards/ and are
+merged into one report.
+"""
+import multiprocessing
+import os
+import re
+import subprocess
+import time
+
+from cache import cache_dir, cache_path, load_json, save_json
+
+SHARD_SETTINGS = '''from {base} import *
+
+for _alias, _database in DATABASES.items():
+    if 'sqlite' not in _database.get('ENGINE', ''):
+        _name = 'test_{{0}}_shard{index}'.format(_database.get('NAME'))
+        _database['TEST_NAME'] = _name
+        _database.setdefault('TEST', {{}})['NAME'] = _name
+'''
+
+_ran = re.compile(r'^Ran (\d+) tests? in ([\d.]+)s', re.M)
+_failed = re.compile(r'^FAILED \((.*)\)', re.M)
+_skipped = re.compile(r'skipped=(\d+)')
+_problem = re.compile(r'^(FAIL|ERROR): (.+)$', re.M)
+
+
+def discover_labels(directory, base='.'):
+    """ Dotted module names (relative to base) of the test*.py files in the packages under directory """
+    labels = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if os.path.isfile(os.path.join(root, d, '__init__.py')))
+        if not os.path.isfile(os.path.join(root, '__init__.py')):
+            continue
+        for name in sorted(files):
+            if name.startswith('test') and name.endswith('.py'):
+                module = os.path.relpath(os.path.join(root, name[:-3]), base)
+                labels.append(module.replace(os.sep, '.'))
+    return labels
+
+
+def plan_shards(suite, labels, workers):
+    """ Split labels into at most `workers` shards of about the same recorded duration """
+    durations = load_json(cache_path('test_durations.json'), default={}).get(suite, {})
+    known = [durations[label] for label in labels if label in durations]
+    default = sum(known) / len(known) if known else 1.0
+    estimates = dict((label, durations.get(label, default)) for label in labels)
+
+    shards = [[] for _ in range(min(workers, len(labels)))]
+    loads = [0.0] * len(shards)
+    for label in sorted(labels, key=lambda l: -estimates[l]):
+        index = loads.index(min(loads))
+        shards[index].append(label)
+        loads[index] += estimates[label]
+    return [shard for shard in shards if shard], estimates
+
+
+def run_shards(suite, labels, command, cwd='.', environment=None, workers=None,
+               liveserver_port=None, sudo=False):
+    """
+        Run `command` (e.g. './manage.py test') once per shard of labels at the
+        same time and print a merged report. Returns True when every shard passed.
+        With sudo the command runs as root, sudo -v should have been run first.
+    """
+    workers = int(workers or multiprocessing.cpu_count())
+    shards, estimates = plan_shards(suite, labels, workers)
+    settings_dir = os.path.abspath(cache_dir('shards'))
+    base_settings = _settings_module(cwd, environment)
+
+    processes = []
+    for index, shard in enumerate(shards):
+        args = "{0} {1}".format(command, " ".join(shard))
+        shard_env = dict(os.environ, **(environment or {}))
+        if base_settings:
+            with open(os.path.join(settings_dir, "shard_settings_{0}.py".format(index)), 'w') as f:
+                f.write(SHARD_SETTINGS.format(base=base_settings, index=index))
+            args += " --settings=shard_settings_{0}".format(index)
+            shard_env['PYTHONPATH'] = os.pathsep.join(
+                [settings_dir, os.path.abspath(cwd)] + filter(None, [shard_env.get('PYTHONPATH')]))
+        if liveserver_port:
+            args += " --liveserver localhost:{0}".format(int(liveserver_port) + index)
+        if sudo:
+            # sudo resets the environment, env puts PYTHONPATH back
+            args = "sudo env PYTHONPATH='{0}' {1}".format(shard_env.get('PYTHONPATH', ''), args)
+        log = os.path.join(settings_dir, "{0}-{1}.log".format(suite, index))
+        print "[shard {0}] {1} ({2:.0f}s expected)".format(index, args, sum(estimates[l] for l in shard))
+        output = open(log, 'w')
+        process = subprocess.Popen(args, shell=True, cwd=cwd, env=shard_env,
+                                   stdout=output, stderr=subprocess.STDOUT)
+        processes.append((index, shard, process, output, log, time.time()))
+
+    results = []
+    for index, shard, process, output, log, started in processes:
+        process.wait()
+        output.close()
+        elapsed = time.time() - started
+        with open(log, 'r') as f:
+            results.append((index, shard, process.returncode, elapsed, f.read(), log))
+
+    _record_durations(suite, results, estimates)
+    return _report(suite, results)
+
+
+def _settings_module(cwd, environment):
+    """ The project's settings module, from the environment or manage.py """
+    if environment and environment.get('DJANGO_SETTINGS_MODULE'):
+        return environment['DJANGO_SETTINGS_MODULE']
+    try:
+        with open(os.path.join(cwd, 'manage.py'), 'r') as f:
+            match = re.search(r'DJANGO_SETTINGS_MODULE["\']\s*,\s*["\']([\w.]+)', f.read())
+    except IOError:
+        return os.environ.get('DJANGO_SETTINGS_MODULE')
+    return match.group(1) if match else os.environ.get('DJANGO_SETTINGS_MODULE')
+
+
+def _record_durations(suite, results, estimates):
+    path = cache_path('test_durations.json')
+    durations = load_json(path, default={})
+    recorded = durations.setdefault(suite, {})
+    for index, shard, returncode, elapsed, output, log in results:
+        total = sum(estimates[label] for label in shard) or 1.0
+        for label in shard:
+            recorded[label] = round(elapsed * estimates[label] / total, 2)
+    save_json(path, durations)
+
+
+def _report(suite, results):
+    tests = failures = errors = skipped = 0
+    problems = []
+    ok = True
+    print "\n{0} shards:".format(suite)
+    for index, shard, returncode, elapsed, output, log in results:
+        ran = _ran.search(output)
+        tests += int(ran.group(1)) if ran else 0
+        failed = _failed.search(output)
+        if failed:
+            counts = dict(part.split('=') for part in failed.group(1).split(', ') if '=' in part)
+            failures += int(counts.get('failures', 0))
+            errors += int(counts.get('errors', 0))
+        skip = _skipped.search(output)
+        skipped += int(skip.group(1)) if skip else 0
+        problems.extend("{0}: {1}".format(kind, test) for kind, test in _problem.findall(output))
+        status = "ok" if returncode == 0 else "FAILED"
+        ok = ok and returncode == 0
+        print "    shard {0}: {1:6} {2:4d} tests {3:7.1f}s  {4}".format(
+            index, status, int(ran.group(1)) if ran else 0, elapsed, log)
+    for problem in problems:
+        print "    " + problem
+    # nothing ran (no shards, or every shard says "Ran 0 tests") is never a pass
+    if not results or (tests == 0 and all(_ran.search(result[4]) for result in results)):
+        print "    no {0} tests ran".format(suite)
+        ok = False
+    print "Ran {0} {1} tests: {2} failures, {3} errors, {4} skipped -> {5}".format(
+        tests, suite, failures, errors, skipped, "OK" if ok else "FAILED")
+    return ok
@@ -0,0 +1,139 @@
+"""
+Run a graph of deploy stages, starting each stage as soon as the stages it
+requires are done, and report the critical path afterwards.
+
+Concurrent stages run in forked processes the same way fabric's @parallel
+does, because cd()/prefix() mutate the global env and can't be shared
+between threads. A stage that is the only one ready runs in-process, so the
+first connection (and any password prompt) happens in the parent.
+"""
+import multiprocessing
+import time
+
+from fabric import state
+from fabric.api import abort, env
+from fabric.network import normalize_to_string
+
+
+class Stage(object):
+    """ A named step of a deploy and the names of the stages it depends on """
+
+    def __init__(self, name, func, requires=()):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+
+    def __repr__(self):
+        return "<Stage {0}>".format(self.name)
+
+
+def run_stages(stages, parallel=True):
+    """
+        Run the stages in dependency order, concurrently where the graph allows.
+        Returns {name: (start, end)} in seconds from the start of the run and
+        aborts once running stages finish if any stage failed.
+    """
+    _check_graph(stages)
+    pending = list(stages)
+    running = {}
+    timings = {}
+    failed = []
+    origin = time.time()
+
+    while pending or running:
+        ready = [] if failed else [
+            stage for stage in pending if all(name in timings for name in stage.requires)]
+        if not ready and not running:
+            break
+
+        if ready and not running and (len(ready) == 1 or not parallel):
+            stage = ready[0]
+            pending.remove(stage)
+            started = time.time() - origin
+            try:
+                stage.func()
+            except (Exception, SystemExit):
+                failed.append(stage.name)
+            timings[stage.name] = (started, time.time() - origin)
+            continue
+
+        if parallel:
+            for stage in ready:
+                pending.remove(stage)
+                process = multiprocessing.Process(target=_run_forked, args=(stage.func,))
+                process.start()
+                running[stage.name] = (process, time.time() - origin)
+
+        time.sleep(0.1)
+        for name, (process, started) in running.items():
+            if not process.is_alive():
+                process.join()
+                if process.exitcode != 0:
+                    failed.append(name)
+                timings[name] = (started, time.time() - origin)
+                del running[name]
+
+    report(stages, timings)
+    if failed:
+        abort("Stage(s) failed: {0}".format(", ".join(failed)))
+    return timings
+
+
+def critical_path(stages, timings):
+    """ The chain of stages, each waiting on the previous, that ended last """
+    by_name = dict((stage.name, stage) for stage in stages)
+    if not timings:
+        return []
+    current = max(timings, key=lambda name: timings[name][1])
+    path = [current]
+    while True:
+        requires = [name for name in by_name[current].requires if name in timings]
+        if not requires:
+            break
+        current = max(requires, key=lambda name: timings[name][1])
+        path.append(current)
+    return list(reversed(path))
+
+
+def report(stages, timings):
+    """ Print when each stage ran and which of them made up the critical path """
+    path = critical_path(stages, timings)
+    print "\nStage timings (* = critical path):"
+    for stage in stages:
+        if stage.name not in timings:
+            print "      {0:24} skipped".format(stage.name)
+            continue
+        start, end = timings[stage.name]
+        marker = "*" if stage.name in path else " "
+        print "    {0} {1:24} {2:7.1f}s -> {3:7.1f}s  {4:7.1f}s".format(
+            marker, stage.name, start, end, end - start)
+    if path:
+        total = max(end for start, end in timings.values())
+        print "Critical path: {0} ({1:.1f}s wall time)".format(" -> ".join(path), total)
+
+
+def _check_graph(stages):
+    """ Abort on unknown or circular requirements before anything runs """
+    by_name = dict((stage.name, stage) for stage in stages)
+    for stage in stages:
+        for name in stage.requires:
+            if name not in by_name:
+                abort("Stage {0} requires unknown stage {1}".format(stage.name, name))
+    done = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [stage for stage in remaining if set(stage.requires) <= done]
+        if not ready:
+            abort("Circular stage requirements between {0}".format(
+                ", ".join(stage.name for stage in remaining)))
+        for stage in ready:
+            done.add(stage.name)
+            remaining.remove(stage)
+
+
+def _run_forked(func):
+    """ Process entry point, drops the inherited ssh connection like fabric's @parallel """
+    if env.host_string:
+        state.connections.pop(normalize_to_string(env.host_string), "")
+    env.linewise = True
+    func()
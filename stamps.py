@@ -0,0 +1,77 @@
+"""
+Steps that only run again when their inputs change.
+
+A Step declares its inputs as glob patterns (fnmatch style, so '*' also
+matches '/', '*/migrations/*.py' finds the migrations of every app) and
+values (e.g. the settings it runs with). When a step succeeds, the hash of
+its inputs is written to .fabcache/stamps/<name>.json, a later run skips the
+step while that hash is the same, unless a step it requires ran. force runs
+every step.
+"""
+import fnmatch
+import hashlib
+import os
+import time
+
+from cache import cache_path, hash_files, load_json, save_json
+
+# never looked into for inputs
+SKIP_DIRECTORIES = set(['.git', '.hg', '.fabcache', 'node_modules', 'venv', '.venv', '__pycache__'])
+
+
+class Step(object):
+    """ A named step of a setup, its input patterns and values, and the steps it comes after """
+
+    def __init__(self, name, func, inputs=(), values=(), requires=()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.values = tuple(values)
+        self.requires = tuple(requires)
+
+    def __repr__(self):
+        return "<Step {0}>".format(self.name)
+
+
+def run_steps(steps, root='.', force=False):
+    """ Run the steps in order, skipping those whose inputs are unchanged. Returns the names that ran """
+    files = project_files(root)
+    ran = []
+    for step in steps:
+        stamp_path = cache_path('stamps', "{0}.json".format(step.name))
+        stamp = load_json(stamp_path, default={})
+        reran = [name for name in step.requires if name in ran]
+        unchanged = stamp.get('digest') == _digest(step, files)
+        if not force and unchanged and not reran:
+            print "{0}: inputs unchanged since {1}, skipping".format(
+                step.name, time.strftime('%Y-%m-%d %H:%M', time.localtime(stamp['time'])))
+            continue
+        if not force and unchanged:
+            print "{0}: running again after {1}".format(step.name, ", ".join(reran))
+        step.func()
+        ran.append(step.name)
+        # steps can create their own inputs (local_settings.py), hash them as they are now
+        files = project_files(root)
+        save_json(stamp_path, {'digest': _digest(step, files), 'time': time.time()})
+    return ran
+
+
+def project_files(root='.'):
+    """ Every file under root, as relative paths """
+    found = []
+    for directory, directories, names in os.walk(root):
+        directories[:] = sorted(
+            name for name in directories if name not in SKIP_DIRECTORIES
+            and not os.path.isfile(os.path.join(directory, name, 'bin', 'activate')))  # virtualenvs
+        for name in names:
+            found.append(os.path.normpath(os.path.join(directory, name)))
+    return found
+
+
+def _digest(step, files):
+    patterns = [os.path.normpath(pattern) for pattern in step.inputs]
+    paths = [path for path in files if any(fnmatch.fnmatch(path, pattern) for pattern in patterns)]
+    digest = hashlib.sha1(hash_files(paths))
+    for value in step.values:
+        digest.update("\0" + str(value))
+    return digest.hexdigest()
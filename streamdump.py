@@ -0,0 +1,86 @@
+"""
+Streaming fixture dump, executed inside `manage.py shell` by
+fixtures.dump_models (never imported by fabric).
+
+Every model of the labels in FIXTURE_DUMP_MODELS (app or app.Model) except
+FIXTURE_DUMP_EXCLUDE goes to its own gzipped JSON file in FIXTURE_DUMP_DIR,
+read FIXTURE_DUMP_CHUNK rows at a time in primary key order so memory stays
+flat. The models are sorted like dumpdata sorts them (natural key
+dependencies first), index.json lists the files in that order with their
+row counts.
+"""
+import gzip
+import json
+import os
+
+from django.core import serializers
+
+try:
+    from django.core.serializers import sort_dependencies
+except ImportError:
+    # before Django 1.7 it lived in the dumpdata command
+    from django.core.management.commands.dumpdata import sort_dependencies
+
+try:
+    from django.apps import apps
+
+    def _models(label):
+        if '.' in label:
+            return [apps.get_model(label)]
+        return list(apps.get_app_config(label).get_models())
+except ImportError:
+    from django.db.models import get_app, get_model, get_models
+
+    def _models(label):
+        if '.' in label:
+            return [get_model(*label.split('.', 1))]
+        return get_models(get_app(label))
+
+
+def _label(model):
+    return "{0}.{1}".format(model._meta.app_label, model._meta.object_name)
+
+
+def dump(labels, exclude, directory, chunk, natural):
+    exclude = set(label.lower() for label in exclude)
+    options = {'use_natural_keys': True} if natural else {}
+    index = {'chunk': chunk, 'natural': natural, 'models': []}
+    models = []
+    for label in labels:
+        for model in _models(label):
+            if _label(model).lower() in exclude or model in models or model._meta.proxy:
+                continue
+            models.append(model)
+    # like dumpdata, so natural keys are loaded before the rows that refer to them
+    for model in sort_dependencies([(None, models)]):
+        name = _label(model)
+        filename = "{0}.json.gz".format(name)
+        rows = 0
+        out = gzip.open(os.path.join(directory, filename), 'wb')
+        try:
+            out.write("[")
+            queryset = model._default_manager.order_by('pk')
+            last = None
+            while True:
+                page = queryset if last is None else queryset.filter(pk__gt=last)
+                objects = list(page[:chunk])
+                if not objects:
+                    break
+                data = serializers.serialize('json', objects, **options).strip()[1:-1]
+                out.write(("," if rows else "") + data)
+                rows += len(objects)
+                last = objects[-1].pk
+            out.write("]")
+        finally:
+            out.close()
+        index['models'].append({'model': name, 'file': filename, 'rows': rows})
+        print "{0:40} {1:8d} rows".format(name, rows)
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+
+
+dump(os.environ['FIXTURE_DUMP_MODELS'].split(),
+     os.environ.get('FIXTURE_DUMP_EXCLUDE', '').split(),
+     os.environ['FIXTURE_DUMP_DIR'],
+     int(os.environ.get('FIXTURE_DUMP_CHUNK', '2000')),
+     bool(os.environ.get('FIXTURE_DUMP_NATURAL')))
@@ -0,0 +1,194 @@
+"""
+Timing of every task and every local()/run()/sudo() call.
+
+The modules import task, local, run and sudo from here instead of from
+fabric.api. Every call appends a json line to .fabcache/timings.jsonl with
+the fab run it belongs to, its kind (task, local, run or sudo), the task it
+ran in, the command (with its secrets redacted, see redact()), host,
+duration and exit status ("failed" when it aborted). `fab core.timings`
+summarizes the log.
+"""
+import functools
+import json
+import math
+import os
+import re
+import threading
+import time
+
+from fabric import api
+from fabric.tasks import WrappedCallableTask
+
+from cache import cache_path, CACHE_DIR
+
+RUN_ID = "{0}-{1}".format(int(time.time()), os.getpid())
+LOG = os.path.join(CACHE_DIR, 'timings.jsonl')
+
+_main_tasks = []
+_thread_tasks = threading.local()
+_write_lock = threading.Lock()
+
+# shell words (quotes and escapes included), KEY=value words, URL passwords and query strings (signed URLs)
+_word = re.compile(r'''(?:[^\s'"\\]|\\.|'[^']*'|"(?:[^"\\]|\\.)*")+''')
+_assignment = re.compile(r'''^['"]?([A-Za-z_][A-Za-z0-9_]*)=''')
+_url_password = re.compile(r'(://[^:/@\s]*:)[^@\s]*@')
+_url_query = re.compile(r'''(://[^?\s'"]*)\?[^\s'"]*''')
+
+
+def _tasks():
+    """ The stack of running tasks of this thread """
+    if threading.current_thread().name == 'MainThread':
+        return _main_tasks
+    if not hasattr(_thread_tasks, 'stack'):
+        _thread_tasks.stack = []
+    return _thread_tasks.stack
+
+
+def current_task():
+    """ Innermost running task, worker threads fall back to the main thread's """
+    stack = _tasks() or _main_tasks
+    return stack[-1] if stack else None
+
+
+def record(kind, task_name, command, host, started, status):
+    entry = {
+        'run': RUN_ID,
+        'time': round(started, 3),
+        'kind': kind,
+        'task': task_name,
+        'command': redact(command)[:500] if command else None,
+        'host': host,
+        'duration': round(time.time() - started, 3),
+        'status': status,
+    }
+    try:
+        with _write_lock:
+            with open(cache_path('timings.jsonl'), 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+    except (IOError, OSError):
+        pass  # never fail a deploy over its timings
+
+
+def redact(command):
+    """
+        The command with the values of KEY=value words (heroku config:set,
+        env prefixes), URL passwords and query strings replaced by ***
+    """
+    def word(match):
+        text = match.group(0)
+        assignment = _assignment.match(text)
+        if assignment:
+            return "{0}=***".format(assignment.group(1))
+        return _url_query.sub(r'\1?***', _url_password.sub(r'\1***@', text))
+    return _word.sub(word, command)
+
+
+def _timed(kind, operation):
+    @functools.wraps(operation)
+    def timed(command, *args, **kwargs):
+        started = time.time()
+        status = 'failed'
+        try:
+            result = operation(command, *args, **kwargs)
+            status = getattr(result, 'return_code', 0)
+            return result
+        finally:
+            host = 'localhost' if kind == 'local' else api.env.host_string
+            record(kind, current_task(), command, host, started, status)
+    return timed
+
+
+local = _timed('local', api.local)
+run = _timed('run', api.run)
+sudo = _timed('sudo', api.sudo)
+
+
+class TimedTask(WrappedCallableTask):
+    """ fabric's task class for @task, times every run of the task """
+
+    def run(self, *args, **kwargs):
+        name = "{0}.{1}".format(self.__module__.split('.')[-1], self.name)
+        tasks = _tasks()
+        tasks.append(name)
+        started = time.time()
+        status = 'failed'
+        try:
+            result = super(TimedTask, self).run(*args, **kwargs)
+            status = 0
+            return result
+        finally:
+            tasks.pop()
+            record('task', name, None, api.env.host_string or 'localhost', started, status)
+
+
+def task(*args, **kwargs):
+    """ fabric's @task (with or without arguments) with TimedTask as the default task_class """
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return TimedTask(args[0])
+    kwargs.setdefault('task_class', TimedTask)
+    return api.task(*args, **kwargs)
+
+
+def load_records(path=LOG):
+    records = []
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of a list of numbers """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = max(0, int(math.ceil(fraction * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def command_group(command):
+    """ What a command is for reporting, e.g. 'heroku maintenance:on' or 'manage.py migrate' """
+    words = command.split()
+    for index, word in enumerate(words):
+        if word.endswith('manage.py'):
+            return " ".join(['manage.py'] + words[index + 1:index + 2])
+    return " ".join(words[:2])
+
+
+def report(records, runs=10, top=10):
+    """ Print the slowest tasks, p50/p95 per command group and task durations over the last runs """
+    tasks = {}
+    commands = {}
+    for entry in records:
+        if entry['kind'] == 'task':
+            tasks.setdefault(entry['task'], []).append(entry)
+        elif entry.get('command'):
+            commands.setdefault(command_group(entry['command']), []).append(entry['duration'])
+
+    print "Slowest tasks (by p50):"
+    ranked = sorted(tasks.items(), key=lambda item: -percentile([e['duration'] for e in item[1]], 0.5))
+    for name, entries in ranked[:top]:
+        durations = [e['duration'] for e in entries]
+        failed = len([e for e in entries if e['status'] != 0])
+        print "    {0:36} {1:4d} runs  p50 {2:8.1f}s  max {3:8.1f}s  {4} failed".format(
+            name, len(durations), percentile(durations, 0.5), max(durations), failed)
+
+    print "\nCommands:"
+    ranked = sorted(commands.items(), key=lambda item: -percentile(item[1], 0.95))
+    for group, durations in ranked[:top * 2]:
+        print "    {0:36} {1:4d} calls  p50 {2:8.2f}s  p95 {3:8.2f}s".format(
+            group, len(durations), percentile(durations, 0.5), percentile(durations, 0.95))
+
+    print "\nTrends (oldest to newest of the last {0} runs):".format(runs)
+    for name, entries in sorted(tasks.items()):
+        per_run = {}
+        for entry in entries:
+            per_run.setdefault(entry['run'], []).append(entry)
+        recent = sorted(per_run.values(), key=lambda e: e[0]['time'])[-runs:]
+        if len(recent) > 1:
+            print "    {0:36} {1}".format(
+                name, " ".join("{0:.1f}s".format(sum(e['duration'] for e in run)) for run in recent))
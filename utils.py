@@ -0,0 +1,17 @@
+"""
+Small helpers shared by the task modules.
+"""
+
+
+def as_bool(value):
+    """ Task arguments from the command line arrive as strings, fab task:force=no is False """
+    return str(value).lower() not in ('', '0', 'false', 'no', 'n', 'none')
+
+
+def projectconf(name, default=None):
+    """ A setting from the project's projectconf.py, imported when a task first needs it """
+    try:
+        import projectconf as conf
+    except ImportError:
+        return default
+    return getattr(conf, name, default)
@@ -0,0 +1,113 @@
+"""
+Skip pip installs when the requirement files haven't changed since the last
+install into the same environment, and when they have, install from a
+wheelhouse so only new or changed packages are built or downloaded. When
+wheels can't be built (no wheel package) pip installs the requirements as
+usual.
+"""
+import os
+import re
+
+from fabric.api import env, put, settings
+
+from cache import CACHE_DIR, cache_path, hash_files, load_json, save_json
+from timing import local, run
+
+WHEELHOUSE = os.path.join(CACHE_DIR, 'wheelhouse')
+
+# the remote requirement files, hashed on the host itself
+REMOTE_REQUIREMENTS_HASH = "cat requirements.txt $(find requirements -name '*.txt' 2>/dev/null | sort) | sha1sum"
+
+FALLBACK_MESSAGE = "Building wheels failed (is the wheel package installed?), installing with plain pip"
+
+_include = re.compile(r'^\s*(?:-r|--requirement)[=\s]\s*(\S+)')
+
+
+def requirement_files(paths):
+    """ The requirement files that exist, plus every file they pull in with -r """
+    found = []
+    queue = list(paths)
+    while queue:
+        path = os.path.normpath(queue.pop(0))
+        if path in found or not os.path.isfile(path):
+            continue
+        found.append(path)
+        with open(path, 'r') as f:
+            for line in f:
+                match = _include.match(line)
+                if match:
+                    queue.append(os.path.join(os.path.dirname(path), match.group(1)))
+    return found
+
+
+def pip_install(paths, force=False):
+    """
+        pip install -r each of the paths that exist, through the local
+        wheelhouse (plain pip install when wheels can't be built). Skipped
+        completely when the resolved files hash the same as the last install
+        into the active environment (unless force). Returns whether pip ran.
+    """
+    requirements = " ".join("-r {0}".format(path) for path in paths if os.path.isfile(path))
+    if not requirements:
+        return False
+    digest = hash_files(requirement_files(paths))
+    stamps_path = cache_path('pip', 'installed.json')
+    target = pip_environment()
+    if not force and load_json(stamps_path, default={}).get(target) == digest:
+        print "Requirements unchanged since the last install, skipping pip"
+        return False
+
+    with settings(warn_only=True):
+        built = local('pip wheel --wheel-dir={0} --find-links={0} {1}'.format(WHEELHOUSE, requirements)).succeeded
+    if built:
+        local('pip install --no-index --find-links={0} {1}'.format(WHEELHOUSE, requirements))
+    else:
+        print FALLBACK_MESSAGE
+        local('pip install {0}'.format(requirements))
+    stamps = load_json(stamps_path, default={})
+    stamps[target] = digest
+    save_json(stamps_path, stamps)
+    return True
+
+
+def ship_wheelhouse(wheelhouse):
+    """
+        Upload the local wheelhouse into the remote one when run with
+        --set ship_wheelhouse=1, before remote_pip_install_command. Only useful
+        when the local and remote platforms match.
+    """
+    if env.get('ship_wheelhouse') and os.path.isdir(WHEELHOUSE) and os.listdir(WHEELHOUSE):
+        run('mkdir -p {0}'.format(wheelhouse))
+        put(os.path.join(WHEELHOUSE, '*.whl'), wheelhouse)
+
+
+def remote_pip_install_command(wheelhouse, stamp):
+    """
+        pip install -r requirements.txt on the remote host as one shell
+        command, run it in the app directory inside the virtualenv. Skipped
+        when there is no requirements.txt or the requirement files hash the
+        same as the last install (kept in `stamp`), wheels are built into (and
+        installed from) the remote `wheelhouse`.
+    """
+    return (
+        'if ! test -f requirements.txt; then '
+        'echo "No requirements.txt, skipping pip"; '
+        'elif test "$({hash})" = "$(cat {stamp} 2>/dev/null)"; then '
+        'echo "Requirements unchanged since the last install, skipping pip"; else '
+        'mkdir -p {wheelhouse} && '
+        '{{ pip wheel --wheel-dir={wheelhouse} --find-links={wheelhouse} -r requirements.txt && '
+        'pip install --no-index --find-links={wheelhouse} -r requirements.txt || '
+        '{{ echo "{fallback}"; pip install -r requirements.txt; }}; }} && '
+        '{hash} > {stamp}; fi').format(hash=REMOTE_REQUIREMENTS_HASH, stamp=stamp, wheelhouse=wheelhouse,
+                                       fallback=FALLBACK_MESSAGE)
+
+
+def pip_environment():
+    """ What the install went into, the active virtualenv or else the pip on PATH """
+    if os.environ.get('VIRTUAL_ENV'):
+        return os.environ['VIRTUAL_ENV']
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        pip = os.path.join(directory, 'pip')
+        if os.access(pip, os.X_OK):
+            return os.path.realpath(pip)
+    return 'pip'
@@ -0,0 +1,42 @@
+"""
+Thread helpers for running independent shell-outs at the same time.
+"""
+import threading
+from Queue import Queue, Empty
+
+
+def run_parallel(func, items, limit=None):
+    """
+        Call func(item) for every item on at most `limit` threads.
+        Returns a list of (item, result, error) in the same order as `items`.
+        Fabric's abort() raises SystemExit, that is caught and returned as the
+        error instead of silently killing the worker thread.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[index] = (item, func(item), None)
+            except (Exception, SystemExit) as e:
+                results[index] = (item, None, e)
+
+    threads = []
+    for _ in range(min(limit or len(items), len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        # join with a timeout so Ctrl+C still reaches the main thread
+        while thread.is_alive():
+            thread.join(0.1)
+    return results